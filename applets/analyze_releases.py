@@ -19,45 +19,40 @@ import applets.fff_deleter as fff_deleter
 import fff_cluster
 
 from utils import cmssw_deploy
+from utils.release_inspector import ReleaseInspector
 
 log = logging.getLogger(__name__)
 
-def find_pull_requests(fp):
+def find_pull_requests(fp, inspector):
     pr = []
-    for entry in os.listdir(fp):
-        m = re.match("merge.(\d+).log", entry)
-        if m is None: continue
+    for entry in inspector.pull_requests(fp, keep_text=True):
+        if not entry["label"].isdigit(): continue
 
-        i = int(m.group(1))
+        i = int(entry["label"])
         p = cmssw_deploy.MergeRequest(id=i, type="merge-topic", label=None, arg=str(i), log=None)
         dct = dict(p._asdict())
-        dct["log"] = None
-
-        mlog_fp = os.path.join(fp, entry)
-        with open(mlog_fp, "r") as f:
-            dct["log"] = f.read().strip()
+        dct["log"] = entry["log"].strip()
 
         pr.append(dct)
 
     return pr
 
-def collect_releases(top):
+def collect_releases(top, inspector):
     for directory in os.listdir(top):
         fp = os.path.realpath(os.path.join(top, directory))
         if not os.path.isdir(fp): continue
 
         log_fp = os.path.join(fp, "make_release.log")
-        if not os.path.exists(log_fp): continue
+        parsed = inspector.parse_file(log_fp, keep_text=True)
+        if parsed is None: continue
 
         log.info("Found release area: %s", directory)
 
         r = cmssw_deploy.ReleaseEntry(name=directory, path=fp, pull_requests=[], options={}, build_time={}, log=None)
 
-        r = r._replace(pull_requests = find_pull_requests(fp))
+        r = r._replace(pull_requests = find_pull_requests(fp, inspector))
         r = r._replace(build_time = os.path.getmtime(log_fp))
-
-        with open(log_fp, "r") as f:
-            r = r._replace(log = f.read().strip())
+        r = r._replace(log = parsed["text"].strip())
 
         yield r
 
@@ -68,9 +63,13 @@ class Analyzer(object):
         self.app_tag = app_tag
         self.hostname = socket.gethostname()
 
+        # logs are only read again if they change
+        self.inspector = ReleaseInspector()
+
     def make_report(self, backlog=5):
         # only last 5 entries
-        for entry in collect_releases(self.top):
+        self.inspector.prune()
+        for entry in collect_releases(self.top, self.inspector):
             id = "dqm-release-%s" % (entry.name)
 
             doc = {
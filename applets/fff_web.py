@@ -2,8 +2,15 @@
 import json
 import re
 import sqlite3
-import os, time
+import os, sys, time
+import bisect
+import queue
+import collections
+import hashlib
+import threading
+import contextlib
 import socket
+import struct
 import logging
 
 import fff_dqmtools
@@ -12,6 +19,11 @@ import applets.fff_filemonitor as fff_filemonitor
 
 # fff_dqmtools fixed the imports for us
 import bottle
+import gevent
+import gevent.event
+import gevent.lock
+import gevent.socket
+import http.client
 import zlib
 import itertools
 import requests
@@ -19,19 +31,976 @@ import requests
 log = logging.getLogger(__name__)
 
 from ws4py.websocket import WebSocket
+from ws4py.client.geventclient import WebSocketClient
+from ws4py.exc import HandshakeError
+
+class HeaderIndex(object):
+    """
+        Resident copy of the Headers table, ordered by rev.
+
+        Entries are the same header dicts we send to the clients,
+        so "all headers with rev > N" is a bisect plus a slice.
+        Entries are shared, they must not be modified by the callers.
+
+        version is bumped on every change, it is used to invalidate
+        anything derived from the index (ie, encoded snapshots).
+
+        The memory used by the entries is counted as they are added and removed.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.clear()
+
+    def clear(self):
+        self.version += 1
+        self.revs = []
+        self.headers = []
+        self.by_id = {}
+        self.header_bytes = 0
+
+    @staticmethod
+    def header_size(header):
+        # approximate, strings shared between headers are counted multiple times
+        return sys.getsizeof(header) + sum(sys.getsizeof(v) for v in header.values())
+
+    def load(self, headers):
+        self.clear()
+        self.update(headers)
+
+    def remove(self, id):
+        old = self.by_id.pop(id, None)
+        if old is None:
+            return None
+
+        self.version += 1
+        i = bisect.bisect_left(self.revs, old["_rev"])
+        del self.revs[i]
+        del self.headers[i]
+        self.header_bytes -= self.header_size(old)
+
+        return old
+
+    def update(self, headers):
+        self.version += 1
+        for header in headers:
+            rev = header["_rev"]
+
+            # concurrent uploads can be applied out of order
+            old = self.by_id.get(header["_id"], None)
+            if old is not None and old["_rev"] > rev:
+                continue
+
+            self.remove(header["_id"])
+            if self.revs and rev < self.revs[-1]:
+                i = bisect.bisect_left(self.revs, rev)
+                self.revs.insert(i, rev)
+                self.headers.insert(i, header)
+            else:
+                self.revs.append(rev)
+                self.headers.append(header)
+
+            self.by_id[header["_id"]] = header
+            self.header_bytes += self.header_size(header)
+
+    def since(self, rev=None, until=None):
+        # headers with rev > rev and rev <= until
+        i, j = 0, len(self.revs)
+        if rev is not None:
+            i = bisect.bisect_right(self.revs, rev)
+        if until is not None:
+            j = bisect.bisect_right(self.revs, until)
+
+        return self.headers[i:j]
+
+    def get(self, id):
+        return self.by_id.get(id, None)
+
+    def find_first_rev(self, timestamp):
+        # the first rev with a timestamp >= timestamp, None if there is none
+        # (timestamps are not ordered by rev)
+        for header in self.headers:
+            t = header.get("timestamp", None)
+            if t is not None and t >= timestamp:
+                return header["_rev"]
+
+        return None
+
+    @property
+    def first_rev(self):
+        if not self.revs:
+            return None
+
+        return self.revs[0]
+
+    @property
+    def last_rev(self):
+        if not self.revs:
+            return None
+
+        return self.revs[-1]
+
+    def __len__(self):
+        return len(self.revs)
+
+    def memory_usage(self):
+        return sys.getsizeof(self.revs) + sys.getsizeof(self.headers) + sys.getsizeof(self.by_id) + self.header_bytes
+
+    def stats(self):
+        return {
+            'headers': len(self),
+            'last_rev': self.last_rev,
+            'memory': self.memory_usage(),
+        }
+
+class ReadPool(object):
+    """
+        A small pool of read-only connections to a WAL database.
+        Readers see the last committed state and are not blocked by the writer.
+    """
+
+    def __init__(self, db_str, size, pragmas=()):
+        self.db_str = db_str
+        self.size = size
+        self.free = queue.Queue()
+
+        uri = "file:%s?mode=ro" % os.path.abspath(db_str)
+        for i in range(size):
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            for pragma in pragmas:
+                conn.execute(pragma)
+
+            self.free.put(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.free.get()
+        try:
+            yield conn
+        finally:
+            self.free.put(conn)
+
+    def close(self):
+        while not self.free.empty():
+            self.free.get().close()
+
+class DatabaseExecutor(object):
+    """
+        Runs blocking sqlite calls on a bounded pool of native threads.
+        The calling greenlet waits for the result, the hub keeps running.
+
+        With threads=0 the calls are executed inline.
+    """
+
+    def __init__(self, threads=4):
+        self.threads = threads
+        self.pool = None
+
+        if self.threads > 0:
+            import gevent.threadpool
+            self.pool = gevent.threadpool.ThreadPool(self.threads)
+
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.executed = 0
+        self.wait_time = 0.
+        self.wait_time_max = 0.
+        self.run_time = 0.
+
+    def _account(self, wait_time=None, run_time=None):
+        with self.lock:
+            if wait_time is not None:
+                self.queued -= 1
+                self.running += 1
+                self.wait_time += wait_time
+                self.wait_time_max = max(self.wait_time_max, wait_time)
+
+            if run_time is not None:
+                self.running -= 1
+                self.executed += 1
+                self.run_time += run_time
+
+    def run(self, f, *args, **kwargs):
+        if self.pool is None:
+            return f(*args, **kwargs)
+
+        submitted = time.time()
+        def job():
+            started = time.time()
+            self._account(wait_time=started - submitted)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self._account(run_time=time.time() - started)
+
+        with self.lock:
+            self.queued += 1
+
+        return self.pool.spawn(job).get()
+
+    def stats(self):
+        with self.lock:
+            n = max(self.executed, 1)
+            return {
+                'threads': self.threads,
+                'queue_depth': self.queued,
+                'running': self.running,
+                'executed': self.executed,
+                'wait_time_avg': self.wait_time / n,
+                'wait_time_max': self.wait_time_max,
+                'run_time_avg': self.run_time / n,
+            }
+
+class UploadDeduplicator(object):
+    """
+        Remembers a digest of the last written body of every id,
+        so identical rewrites can be skipped without a new revision.
+
+        Volatile fields (always_volatile plus the per-type lists)
+        are excluded from the digest, dotted names refer to nested keys.
+        Unchanged documents are still written once they are older than max_age,
+        otherwise their timestamp would look stale in the web interface.
+        Until then a skipped upload leaves the stored document as it was,
+        with the timestamp of the last write (at most max_age seconds old).
+    """
+
+    always_volatile = ["_rev", "timestamp", "report_timestamp", "sequence"]
+
+    def __init__(self, volatile=None, max_age=60):
+        self.volatile = volatile or {}
+        self.max_age = max_age
+
+        self.digests = {}
+        self.skipped = 0
+
+    def _strip(self, doc, path):
+        key, _, rest = path.partition(".")
+        if key not in doc:
+            return doc
+
+        doc = dict(doc)
+        if rest and isinstance(doc[key], dict):
+            doc[key] = self._strip(doc[key], rest)
+        elif not rest:
+            del doc[key]
+
+        return doc
+
+    def digest(self, doc):
+        for path in self.always_volatile + self.volatile.get(doc.get("type"), []):
+            doc = self._strip(doc, path)
+
+        body = json.dumps(doc, sort_keys=True).encode("utf-8")
+        return hashlib.sha1(body).digest()
+
+    def is_unchanged(self, id, digest, now):
+        known = self.digests.get(id, None)
+        if known is None:
+            return False
+
+        known_digest, written = known
+        return known_digest == digest and (now - written) < self.max_age
+
+    def remember(self, id, digest, now):
+        self.digests[id] = (digest, now, )
+
+    def forget(self, id):
+        self.digests.pop(id, None)
+
+    def stats(self):
+        return {
+            'ids': len(self.digests),
+            'skipped': self.skipped,
+        }
+
+class DictionaryStore(object):
+    """
+        Versioned zlib preset dictionaries, one per document type.
+
+        Dictionaries are trained from a sample of stored bodies
+        and are never modified, new versions get a new id.
+        Rows keep the id of the dictionary they were compressed with (NULL for none),
+        so old rows stay readable after retraining.
+
+        A retrained dictionary is only kept if it compresses (a held out half of)
+        the samples at least min_gain better than the current one,
+        dictionaries no longer referenced by any row are deleted (see prune).
+    """
+
+    fragment_re = re.compile(r'"(?:[^"\\]|\\.)*"(?:: )?')
+
+    def __init__(self, enabled=False, min_samples=16, max_samples=64, max_age=24*3600, min_gain=0.05):
+        self.enabled = enabled
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.max_age = max_age
+        self.min_gain = min_gain
+
+        self.dicts = {}     # dict_id -> zdict
+        self.current = {}   # type -> (dict_id, created)
+        self.checked = {}   # type -> time of the last training, kept or not
+
+        self.rejected = 0
+        self.pruned = 0
+
+    def load(self, conn):
+        # only the dictionaries in use: referenced by a row, or the current one of a type
+        c = conn.cursor()
+        c.execute("""SELECT id, type, created, zdict FROM Dictionaries
+            WHERE id IN (SELECT DISTINCT dict_id FROM Documents WHERE dict_id IS NOT NULL)
+               OR id IN (SELECT MAX(id) FROM Dictionaries GROUP BY type)
+            ORDER BY id ASC""")
+        for dict_id, type, created, zdict in c.fetchall():
+            self.add(dict_id, type, created, bytes(zdict))
+        c.close()
+
+    def prune(self, db):
+        """
+            Deletes the dictionaries which are neither current nor used by any row,
+            db has to be the writer connection (under the writer lock).
+        """
+        current = set(dict_id for dict_id, created in self.current.values())
+        used = set(x for x, in db.execute("SELECT DISTINCT dict_id FROM Documents WHERE dict_id IS NOT NULL"))
+
+        unused = [dict_id for dict_id, in db.execute("SELECT id FROM Dictionaries")
+            if dict_id not in current and dict_id not in used]
+
+        db.executemany("DELETE FROM Dictionaries WHERE id = ?", [(dict_id, ) for dict_id in unused])
+        for dict_id in unused:
+            self.dicts.pop(dict_id, None)
+
+        self.pruned += len(unused)
+        return unused
+
+    def add(self, dict_id, type, created, zdict):
+        self.dicts[dict_id] = zdict
+        self.current[type] = (dict_id, created, )
+
+    def compress(self, type, data):
+        if not self.enabled or type not in self.current:
+            return zlib.compress(data), None
+
+        dict_id = self.current[type][0]
+        c = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY, self.dicts[dict_id])
+        return c.compress(data) + c.flush(), dict_id
+
+    def decompress(self, body, dict_id):
+        if dict_id is None:
+            return zlib.decompress(body)
+
+        d = zlib.decompressobj(zdict=self.dicts[dict_id])
+        return d.decompress(body) + d.flush()
+
+    @classmethod
+    def train(cls, samples, size=32*1024):
+        """
+            Builds a dictionary from a list of (json) bytes.
+            Keys and string values found in at least half of the samples
+            go at the end (most valuable last, closest to the data),
+            the rest is filled with the most recent sample.
+        """
+
+        counts = {}
+        for sample in samples:
+            for fragment in set(cls.fragment_re.findall(sample.decode("utf-8", "replace"))):
+                counts[fragment] = counts.get(fragment, 0) + 1
+
+        min_count = max(2, len(samples) // 2)
+        fragments = [f for f, c in counts.items() if c >= min_count]
+        fragments.sort(key=lambda f: counts[f] * len(f))
+
+        tail, tail_size = [], 0
+        for fragment in reversed(fragments):
+            fb = fragment.encode("utf-8")
+            if tail_size + len(fb) > size // 2:
+                break
+
+            tail.insert(0, fb)
+            tail_size += len(fb)
+
+        head = samples[0][:size - tail_size]
+        return head + b"".join(tail)
+
+    @staticmethod
+    def compressed_size(samples, zdict=None):
+        size = 0
+        for sample in samples:
+            if zdict is None:
+                c = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, zlib.MAX_WBITS, 9)
+            else:
+                c = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY, zdict)
+            size += len(c.compress(sample) + c.flush())
+
+        return size
+
+    def retrain(self, type, samples):
+        """
+            Returns a new dictionary for the type, trained from half of the samples,
+            or None if it is not better than the current one on the other half.
+        """
+        train, test = samples[1::2], samples[0::2]
+        zdict = self.train(train)
+
+        current = None
+        if type in self.current:
+            current = self.dicts[self.current[type][0]]
+
+        new_size = self.compressed_size(test, zdict)
+        old_size = self.compressed_size(test, current)
+        if new_size > old_size * (1 - self.min_gain):
+            self.rejected += 1
+            return None
+
+        return zdict
+
+    def needs_training(self, type, count, now):
+        if type is None or count < self.min_samples:
+            return False
+
+        last = max(self.current.get(type, (None, 0))[1], self.checked.get(type, 0))
+        return (now - last) > self.max_age
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'loaded': len(self.dicts),
+            'rejected': self.rejected,
+            'pruned': self.pruned,
+            'types': dict((type, { 'id': id, 'created': created, 'size': len(self.dicts[id]) })
+                for type, (id, created) in self.current.items()),
+        }
+
+class DocumentCache(object):
+    """
+        Byte-bounded LRU of ready-to-send document bodies, keyed by (id, rev, encoding).
+        Only the latest revision of an id is kept.
+
+        Encodings are "json" (the stored json) and "deflate",
+        (is_deflate, body) pairs as returned by prepare_docs (the stored zlib stream if possible).
+        A deflate read of a document with only a json body takes the json one.
+
+        The cache is filled by reads, writes only refresh the ids already cached
+        (so a stream of uploads nobody reads does not push out the hot documents).
+    """
+
+    ENCODINGS = ("json", "deflate", )
+
+    def __init__(self, max_bytes=64*1024*1024):
+        self.max_bytes = max_bytes
+
+        self.entries = collections.OrderedDict()
+        self.revs = {} # id -> rev
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _size(body):
+        if isinstance(body, tuple):
+            return len(body[1])
+
+        return len(body)
+
+    def _lookup(self, key):
+        body = self.entries.get(key, None)
+        if body is not None:
+            self.entries.move_to_end(key)
+
+        return body
+
+    def get(self, id, rev, encoding="json"):
+        body = self._lookup((id, rev, encoding, ))
+        if body is None and encoding == "deflate":
+            body = self._lookup((id, rev, "json", ))
+            if body is not None:
+                body = (False, body, )
+
+        if body is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return body
+
+    def _remove(self, key):
+        body = self.entries.pop(key)
+        self.size -= self._size(body)
+
+        id, rev, _ = key
+        if not any((id, rev, e, ) in self.entries for e in self.ENCODINGS):
+            del self.revs[id]
+
+    def _remove_id(self, id):
+        rev = self.revs.get(id, None)
+        for e in self.ENCODINGS:
+            if (id, rev, e, ) in self.entries:
+                self._remove((id, rev, e, ))
+
+    def put(self, id, rev, body, encoding="json"):
+        old_rev = self.revs.get(id, None)
+        if old_rev is not None:
+            if old_rev > rev:
+                return
+
+            if old_rev < rev:
+                self._remove_id(id)
+            elif (id, rev, encoding, ) in self.entries:
+                self._remove((id, rev, encoding, ))
+
+        size = self._size(body)
+        if size > self.max_bytes:
+            return
+
+        self.entries[(id, rev, encoding, )] = body
+        self.revs[id] = rev
+        self.size += size
+
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def refresh(self, id, rev, body):
+        # json body of a new revision, the other encodings of the old one are dropped
+        if id in self.revs:
+            self.put(id, rev, body)
+
+    def invalidate(self, id):
+        if id in self.revs:
+            self._remove_id(id)
+            self.invalidations += 1
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'size': self.size,
+            'max_size': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+def json_diff(old, new, path=()):
+    """
+        Structural difference between two json values, as a list of operations:
+            ["set", path, value], ["del", path],
+            ["append", path, values], ["shift", path, n] (drops n elements from the front).
+
+        Paths are lists of keys and indexes, an empty path is the value itself.
+    """
+
+    if type(old) != type(new):
+        return [["set", list(path), new]]
+
+    if isinstance(old, dict):
+        ops = []
+        for k in old:
+            if k not in new:
+                ops.append(["del", list(path) + [k]])
+
+        for k, v in new.items():
+            if k not in old:
+                ops.append(["set", list(path) + [k], v])
+            elif old[k] != v:
+                ops += json_diff(old[k], v, path + (k, ))
+
+        return ops
+
+    if isinstance(old, list):
+        n = len(old)
+
+        # (rolling) buffers: elements are appended, old ones removed from the front
+        shift = 0
+        if old and new and old[0] != new[0] and new[0] in old:
+            shift = old.index(new[0])
+
+        kept = n - shift
+        if len(new) >= kept and new[:kept] == old[shift:]:
+            ops = []
+            if shift:
+                ops.append(["shift", list(path), shift])
+            if len(new) > kept:
+                ops.append(["append", list(path), new[kept:]])
+
+            return ops
+
+        if len(new) == n:
+            ops = []
+            for i in range(n):
+                if old[i] != new[i]:
+                    ops += json_diff(old[i], new[i], path + (i, ))
+
+            return ops
+
+        return [["set", list(path), new]]
+
+    if old != new:
+        return [["set", list(path), new]]
+
+    return []
+
+class DocumentDeltas(object):
+    """
+        Keeps the latest revision of the documents clients are subscribed to
+        and the delta between it and the previous revision (see json_diff),
+        so subscribed clients only receive the change.
+    """
+
+    def __init__(self):
+        self.tracked = {} # id -> number of subscribed clients
+        self.latest = {} # id -> (rev, doc)
+        self.deltas = {} # id -> (base_rev, rev, json)
+
+        self.computed = 0
+        self.delta_bytes = 0
+
+    def track(self, ids):
+        for id in ids:
+            self.tracked[id] = self.tracked.get(id, 0) + 1
+
+    def untrack(self, ids):
+        for id in ids:
+            count = self.tracked.get(id, 0) - 1
+            if count > 0:
+                self.tracked[id] = count
+                continue
+
+            self.tracked.pop(id, None)
+            self.latest.pop(id, None)
+            self.deltas.pop(id, None)
+
+    def is_tracked(self, id):
+        return id in self.tracked
+
+    def record(self, id, rev, doc):
+        # called after the commit, uploads can be recorded out of order
+        old = self.latest.get(id, None)
+        if old is not None and old[0] >= rev:
+            return
+
+        self.latest[id] = (rev, doc, )
+        if old is None:
+            return
+
+        delta = json.dumps({
+            '_id': id,
+            'base_rev': old[0],
+            '_rev': rev,
+            'ops': json_diff(old[1], doc),
+        }).encode("utf-8")
+
+        self.deltas[id] = (old[0], rev, delta, )
+        self.computed += 1
+        self.delta_bytes += len(delta)
+
+    def get(self, id, base_rev, rev):
+        # the delta from base_rev to rev, if there is one
+        d = self.deltas.get(id, None)
+        if d is None or d[0] != base_rev or d[1] != rev:
+            return None
+
+        return d[2]
+
+    def forget(self, id):
+        self.latest.pop(id, None)
+        self.deltas.pop(id, None)
+
+    def stats(self):
+        return {
+            'tracked': len(self.tracked),
+            'latest': len(self.latest),
+            'computed': self.computed,
+            'delta_bytes': self.delta_bytes,
+        }
+
+# the order of the columns in the "columns" format
+HEADER_COLUMNS = ["_id", "_rev", "timestamp", "hostname", "type", "tag", "run"]
+
+# these repeat a lot, they are sent as indexes into a string table
+HEADER_STRING_COLUMNS = set(["hostname", "type", "tag"])
+
+def encode_header_columns(headers):
+    """
+        Columnar form of a list of headers (the "columns" format).
+
+        Every column is a list with a value per header, values of
+        HEADER_STRING_COLUMNS are indexes into "strings" (None stays None),
+        "_rev" is delta encoded (the first value is the rev itself).
+        Keys outside of HEADER_COLUMNS are appended as plain columns.
+    """
+
+    keys = list(HEADER_COLUMNS)
+    for header in headers:
+        for k in header:
+            if k not in keys:
+                keys.append(k)
+
+    strings = []
+    string_index = {}
+
+    columns = {}
+    for k in keys:
+        if k in HEADER_STRING_COLUMNS:
+            col = []
+            for header in headers:
+                v = header.get(k, None)
+                if v is not None:
+                    i = string_index.get(v, None)
+                    if i is None:
+                        i = string_index[v] = len(strings)
+                        strings.append(v)
+                    v = i
+
+                col.append(v)
+        elif k == "_rev":
+            col = []
+            last = 0
+            for header in headers:
+                col.append(header["_rev"] - last)
+                last = header["_rev"]
+        else:
+            col = [header.get(k, None) for header in headers]
+
+        columns[k] = col
+
+    return {
+        'count': len(headers),
+        'keys': keys,
+        'strings': strings,
+        'columns': columns,
+    }
+
+def iter_header_frames(headers, max_size=1000, format=None, **extra):
+    """
+        Encodes a rev ordered list of headers into update_headers frames (utf-8 bytes).
+        Sending is split into messages of max_size headers,
+        this should be extremely helpful with users on bad connections.
+
+        format="columns" sends the headers in columnar form (see encode_header_columns),
+        otherwise they are sent as a list of dicts.
+
+        Frames are encoded as they are consumed.
+    """
+
+    total_avail = len(headers)
+    total_sent = 0
+
+    last_rev = headers[-1]["_rev"]
+
+    for i in range(0, total_avail, max_size):
+        to_send = headers[i:i + max_size]
+        total_sent += len(to_send)
+
+        frame = {
+            'event': 'update_headers',
+            'rev': [to_send[0]["_rev"], to_send[-1]["_rev"]],
+            'sync_to_rev': last_rev,
+
+            'total_sent': total_sent,
+            'total_avail': total_avail,
+        }
+
+        if format == "columns":
+            frame['format'] = format
+            frame.update(encode_header_columns(to_send))
+        else:
+            frame['headers'] = to_send
+
+        frame.update(extra)
+
+        yield json.dumps(frame).encode("utf-8")
+
+def encode_header_frames(headers, max_size=1000, format=None, **extra):
+    return list(iter_header_frames(list(headers), max_size=max_size, format=format, **extra))
+
+class HeaderBroadcast(object):
+    """
+        Fans header updates out to the listeners.
+
+        A batch is encoded once per distinct subscription filter and format,
+        the same (immutable) frames are handed to every listener with that filter.
+
+        Encoded snapshots are cached as well, only the ones shared by the clients
+        (the sync window of a fresh client, the older headers) have a key,
+        the catch up of a reconnecting client starts at its own rev and is not kept.
+        They stay valid until the index changes (see HeaderIndex.version).
+        Snapshots are encoded while they are being sent,
+        only the ones smaller than max_snapshot_bytes are kept.
+    """
+
+    def __init__(self, max_snapshots=4, max_snapshot_bytes=8*1024*1024):
+        self.max_snapshots = max_snapshots
+        self.max_snapshot_bytes = max_snapshot_bytes
+        self.snapshots = collections.OrderedDict()
+        self.snapshot_version = None
+        self.snapshot_hits = 0
+        self.snapshot_misses = 0
+
+        self.batches = 0
+        self.encoded_frames = 0
+        self.encoded_bytes = 0
+        self.encode_time = 0.
+        self.deliveries = 0
+
+    def encode(self, headers, format=None, **extra):
+        started = time.time()
+        frames = encode_header_frames(headers, format=format, **extra)
+
+        self.encode_time += time.time() - started
+        self.encoded_frames += len(frames)
+        self.encoded_bytes += sum(len(f) for f in frames)
+
+        return frames
+
+    def snapshot(self, version, key, headers, format=None, **extra):
+        # returns an iterator over the frames
+        # key identifies the snapshot (window, filter, format and extra)
+        # for the index version the headers were taken from, None is not cached
+        if key is None:
+            return self._stream_snapshot(version, key, headers, format=format, **extra)
+
+        if version != self.snapshot_version:
+            self.snapshots.clear()
+            self.snapshot_version = version
+
+        frames = self.snapshots.get(key, None)
+        if frames is not None:
+            self.snapshots.move_to_end(key)
+            self.snapshot_hits += 1
+            return iter(frames)
+
+        self.snapshot_misses += 1
+        return self._stream_snapshot(version, key, headers, format=format, **extra)
+
+    def _stream_snapshot(self, version, key, headers, **extra):
+        frames = []
+        size = 0
+
+        for frame in iter_header_frames(headers, **extra):
+            self.encoded_frames += 1
+            self.encoded_bytes += len(frame)
+
+            if frames is not None:
+                size += len(frame)
+                frames.append(frame)
+
+                if size > self.max_snapshot_bytes:
+                    frames = None
+
+            yield frame
+
+        if key is not None and frames is not None and version == self.snapshot_version:
+            self.snapshots[key] = frames
+            while len(self.snapshots) > self.max_snapshots:
+                self.snapshots.popitem(last=False)
+
+    def send(self, listeners, headers):
+        groups = collections.OrderedDict()
+        filtered = {}
+        for client in listeners:
+            f = getattr(client, "filter", None)
+            key = f.key if f is not None else None
+            format = getattr(client, "format", None)
+
+            groups.setdefault((key, format, ), (f, format, []))[2].append(client)
+
+        self.batches += 1
+        for (key, _), (f, format, clients) in groups.items():
+            # a failing group must not stop the others (or the upload which published the headers)
+            try:
+                if key not in filtered:
+                    filtered[key] = headers if f is None else f.apply(headers)
+
+                subset = filtered[key]
+                if not subset:
+                    continue
+
+                frames = self.encode(subset, format=format)
+            except Exception:
+                log.warning("Header broadcast failed for filter %s.", key, exc_info=True)
+                continue
+
+            for client in clients:
+                client.updateHeaders(subset, frames)
+                self.deliveries += len(frames)
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'encoded_frames': self.encoded_frames,
+            'encoded_bytes': self.encoded_bytes,
+            'encode_time': self.encode_time,
+            'deliveries': self.deliveries,
+            'snapshots': len(self.snapshots),
+            'snapshot_hits': self.snapshot_hits,
+            'snapshot_misses': self.snapshot_misses,
+        }
 
 class Database(object):
-    def __init__(self, db=None):
+    # used for the (opt-in) wal mode
+    WAL_PRAGMAS = [
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA cache_size=-16384",     # in KiB, 16 MiB
+        "PRAGMA mmap_size=268435456",   # 256 MiB
+    ]
+
+    def __init__(self, db=None, wal=False, readers=2, threads=0, dedup=None, zdicts=None, cache=None, deltas=None):
         self.db_str = db
+        self.dedup = dedup
+        self.cache = cache
+        self.deltas = deltas
+
+        # rows compressed with dictionaries have to be readable
+        # even if the dictionary mode is switched off
+        self.zdicts = zdicts or DictionaryStore(enabled=False)
 
         if not self.db_str:
             self.db_str = ":memory:"
 
         self.listeners = []
-        self.conn = sqlite3.connect(self.db_str)
+        self.broadcast = HeaderBroadcast()
+
+        # long-poll (http) clients wait on this, it is replaced after every update
+        self.rev_changed = gevent.event.Event()
+        self.rev_waiters = 0
+
+        # the writer connection is used from the executor threads,
+        # self.lock serializes access to it
+        self.conn = sqlite3.connect(self.db_str, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.executor = DatabaseExecutor(threads)
+
+        # commits waiting to be applied to the index (and broadcasted)
+        # greenlets resume from the executor in any order, so whichever comes first
+        # publishes everything committed so far
+        self.committed = collections.deque()
+        self.publish_lock = gevent.lock.Semaphore()
+
+        # in-memory databases can't be shared between connections
+        self.wal = wal and (self.db_str != ":memory:")
+        self.read_pool = None
+
+        if self.wal:
+            mode = self.conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+            for pragma in self.WAL_PRAGMAS:
+                self.conn.execute(pragma)
+
+            log.info("Database journal mode: %s", mode)
 
         # create tables if none
         self.create_tables()
+        self.zdicts.load(self.conn)
+
+        if self.wal and readers > 0:
+            self.read_pool = ReadPool(self.db_str, readers, pragmas=self.WAL_PRAGMAS[1:])
+
+        # headers are served from memory, sqlite is only used to load them
+        self.index = HeaderIndex()
+        self.load_headers()
 
     def drop_tables(self):
         cur = self.conn.cursor()
@@ -44,6 +1013,11 @@ class Database(object):
     def create_tables(self):
         cur = self.conn.cursor()
 
+        # auto_vacuum can only be changed on an empty database (or with a VACUUM),
+        # new databases give the pages back incrementally, see RetentionEngine
+        if cur.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0:
+            cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+
         cur.execute("""
         CREATE TABLE IF NOT EXISTS Headers (
             id TEXT PRIMARY KEY NOT NULL,
@@ -64,6 +1038,19 @@ class Database(object):
             body BLOB
         )""")
 
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS Dictionaries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            type TEXT,
+            created TIMESTAMP,
+            zdict BLOB
+        )""")
+
+        # databases created before the dictionary compression
+        columns = [x[1] for x in cur.execute("PRAGMA table_info(Documents)").fetchall()]
+        if "dict_id" not in columns:
+            cur.execute("ALTER TABLE Documents ADD COLUMN dict_id INT")
+
         cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS M_rev_index ON Headers (rev)")
         cur.execute("CREATE INDEX IF NOT EXISTS M_timestamp_index ON Headers (timestamp)")
 
@@ -98,15 +1085,28 @@ class Database(object):
         return header
 
     def prepare_docs(self, c, decode=True):
+        # decode=True yields the parsed documents
+        # decode="json" yields the stored json (bytes), without parsing it
+        # decode="deflate" yields (is_deflate, body) pairs: plain zlib streams are passed as stored,
+        #   bodies compressed with a preset dictionary are returned as json
+        # decode=False yields the stored (compressed) bodies
         columns = list(map(lambda x: x[0], c.description))
         body_column = columns.index("body")
+        dict_column = columns.index("dict_id")
 
         for x in c.fetchall():
             body = x[body_column]
+            dict_id = x[dict_column]
 
-            if decode:
-                body = zlib.decompress(body)
-                body = json.loads(body)
+            if decode == "deflate":
+                if dict_id is None:
+                    body = (True, bytes(body), )
+                else:
+                    body = (False, self.zdicts.decompress(body, dict_id), )
+            elif decode:
+                body = self.zdicts.decompress(body, dict_id)
+                if decode != "json":
+                    body = json.loads(body)
 
             yield body
 
@@ -119,79 +1119,312 @@ class Database(object):
 
             yield hit
 
-    def get_headers(self, reload=False, from_rev=None):
-        with self.conn as db:
+    @contextlib.contextmanager
+    def reader(self):
+        # in wal mode, reads go through the pool and do not wait for uploads
+        # otherwise they share the writer connection
+        if self.read_pool is None:
+            with self.lock:
+                yield self.conn
+        else:
+            with self.read_pool.connection() as conn:
+                yield conn
+
+    def db_size(self):
+        def query():
+            with self.reader() as db:
+                c = db.cursor()
+                c.execute("PRAGMA page_size")
+                ps = c.fetchone()[0]
+                c.execute("PRAGMA page_count")
+                pc = c.fetchone()[0]
+                c.close()
+
+            return ps*pc
+
+        return self.executor.run(query)
+
+    def get_documents(self, ids, decode=True):
+        ids = list(set(ids))
+        if not ids:
+            return []
+
+        return self.executor.run(self._get_documents, ids, decode)
+
+    def _get_documents(self, ids, decode):
+        with self.reader() as db:
             c = db.cursor()
-            if from_rev is None:
-                c.execute("SELECT id, rev, timestamp, type, hostname, tag, run FROM Headers ORDER BY rev ASC")
-            else:
-                from_rev = int(from_rev)
-                c.execute("SELECT id, rev, timestamp, type, hostname, tag, run FROM Headers WHERE rev > ? ORDER BY rev ASC", (from_rev, ))
 
-            headers = list(self.prepare_headers(c))
+            IN = "(" + ",".join("?"*len(ids)) + ")"
+            c.execute("SELECT * FROM Documents WHERE id IN " + IN, ids)
+
+            docs = list(self.prepare_docs(c, decode=decode))
             c.close()
 
-        #self.find_first_rev(3600*24*16)
+        return docs
 
-        return headers
+    def get_document_bodies(self, ids, encoding="json"):
+        # returns the stored json (bytes) of the documents,
+        # or (is_deflate, body) pairs with encoding="deflate" (see prepare_docs),
+        # hot documents are served from the cache
+        if self.cache is None:
+            return self.get_documents(ids, decode=encoding)
 
-    def find_first_rev(self, seconds):
-        x = time.time() - seconds
-        with self.conn as db:
+        bodies, missing = [], []
+        for id in set(ids):
+            header = self.index.get(id)
+            body = None
+            if header is not None:
+                body = self.cache.get(id, header["_rev"], encoding)
+
+            if body is None:
+                missing.append(id)
+            else:
+                bodies.append(body)
+
+        if missing:
+            for id, rev, body in self.executor.run(self._get_document_bodies, missing, encoding):
+                # do not cache if an upload replaced it in the meantime
+                header = self.index.get(id)
+                if header is not None and header["_rev"] == rev:
+                    self.cache.put(id, rev, body, encoding)
+
+                bodies.append(body)
+
+        return bodies
+
+    def _get_document_bodies(self, ids, encoding="json"):
+        with self.reader() as db:
             c = db.cursor()
-            c.execute("SELECT rev, timestamp FROM Headers WHERE timestamp >= ? ORDER BY rev ASC LIMIT 1", (x, ))
-            r =  c.fetchone()
 
+            IN = "(" + ",".join("?"*len(ids)) + ")"
+            c.execute("SELECT id, rev, body, dict_id FROM Documents WHERE id IN " + IN, ids)
+
+            rows = c.fetchall()
             c.close()
 
+        if encoding == "deflate":
+            return [(id, rev, (True, bytes(body), ) if dict_id is None else (False, self.zdicts.decompress(body, dict_id), ))
+                for id, rev, body, dict_id in rows]
+
+        return [(id, rev, self.zdicts.decompress(body, dict_id)) for id, rev, body, dict_id in rows]
+
+    def get_document(self, id, decode=True):
+        docs = self.get_documents([id], decode=decode)
+        if not docs:
+            return None
+
+        return docs[0]
+
+    def load_headers(self):
+        def query():
+            with self.reader() as db:
+                c = db.cursor()
+                c.execute("SELECT id, rev, timestamp, type, hostname, tag, run FROM Headers ORDER BY rev ASC")
+                headers = list(self.prepare_headers(c))
+                c.close()
+
+            return headers
+
+        self.index.load(self.executor.run(query))
+
+        log.info("Loaded %d headers into the index (last rev %s).", len(self.index), self.index.last_rev)
+
+    def get_headers(self, reload=False, from_rev=None, to_rev=None):
+        if reload:
+            self.load_headers()
+
+        if from_rev is not None:
+            from_rev = int(from_rev)
+
+        if to_rev is not None:
+            to_rev = int(to_rev)
+
+        return self.index.since(from_rev, to_rev)
+
+    def find_first_rev(self, seconds):
+        # the first rev with a timestamp inside the last n seconds, None if there is none
+        return self.index.find_first_rev(time.time() - seconds)
+
     def direct_transactional_upload(self, bodydoc_generator):
+        # parsing, compression and the commit run in the executor,
+        # index and websockets are updated from the calling greenlet
+        try:
+            self.executor.run(self._write_documents, bodydoc_generator)
+        finally:
+            self._publish()
+
+    def _publish(self):
+        with self.publish_lock:
+            while self.committed:
+                headers, bodies, tracked = self.committed.popleft()
+
+                # documents being read will be requested again right after the update
+                if self.cache is not None:
+                    for header, body in zip(headers, bodies):
+                        self.cache.refresh(header["_id"], header["_rev"], body)
+
+                # track/untrack run on the hub, so do the deltas
+                for id, rev, doc in tracked:
+                    if self.deltas.is_tracked(id):
+                        self.deltas.record(id, rev, doc)
+
+                self.index.update(headers)
+                self.update_headers(headers)
+
+    def _write_documents(self, bodydoc_generator):
         headers = [] # this is used to notify websockets
-        with self.conn as db:
-            rev = None
-
-            def get_last_rev():
-                cur = db.cursor()
-                x = cur.execute("SELECT MAX(rev) FROM Headers")
-                r = (x.fetchone()[0] or 0)
-                cur.close()
-                return r
-
-            for body in bodydoc_generator:
-                if rev is None:
-                    rev = get_last_rev()
-
-                # get the document
-                if isinstance(body, str):
-                    doc = json.loads(body)
-                else:
-                    doc = body
+        bodies = [] # json, as stored
+        header_rows, document_rows = [], []
+
+        # digests (and subscribed documents) are only remembered after the commit
+        digests = {}
+        tracked = []
+        now = time.time()
+
+        with self.lock:
+            with self.conn as db:
+                rev = None
+
+                def get_last_rev():
+                    cur = db.cursor()
+                    x = cur.execute("SELECT MAX(rev) FROM Headers")
+                    r = (x.fetchone()[0] or 0)
+                    cur.close()
+                    return r
+
+                for body in bodydoc_generator:
+                    if rev is None:
+                        rev = get_last_rev()
+
+                    # get the document
+                    if isinstance(body, str):
+                        doc = json.loads(body)
+                    else:
+                        doc = body
+
+                    if self.dedup is not None:
+                        id = doc.get("_id")
+                        digest = self.dedup.digest(doc)
+
+                        if digests.get(id, None) == digest or self.dedup.is_unchanged(id, digest, now):
+                            self.dedup.skipped += 1
+                            continue
+
+                        digests[id] = digest
+
+                    # not that we ever overflow it ...
+                    rev = (rev + 1) & ((2**63)-1)
+
+                    # create the header and update the body
+                    header = self.make_header(doc, rev=rev, write_back=True)
+                    data = json.dumps(doc).encode("utf-8")
+                    body, dict_id = self.zdicts.compress(header.get("type"), data)
+
+                    header_rows.append((
+                        header.get("_id"),
+                        header.get("_rev"),
+                        header.get("timestamp"),
+                        header.get("type"),
+                        header.get("hostname"),
+                        header.get("tag"),
+                        header.get("run"),
+                    ))
+
+                    document_rows.append((
+                        header.get("_id"),
+                        header.get("_rev"),
+                        sqlite3.Binary(body),
+                        dict_id,
+                    ))
+
+                    headers.append(header)
+                    bodies.append(data)
+
+                    if self.deltas is not None and self.deltas.is_tracked(header["_id"]):
+                        tracked.append((header["_id"], rev, doc, ))
+
+                db.executemany("INSERT OR REPLACE INTO Headers (id, rev, timestamp, type, hostname, tag, run) VALUES (?, ?, ?, ?, ?, ?, ?)", header_rows)
+                db.executemany("INSERT OR REPLACE INTO Documents (id, rev, body, dict_id) VALUES (?, ?, ?, ?)", document_rows)
+
+            # published (see _publish) in the commit order, which is the rev order
+            self.committed.append((headers, bodies, tracked, ))
+
+        for id, digest in digests.items():
+            self.dedup.remember(id, digest, now)
+
+    def train_dictionaries(self):
+        def train():
+            now = time.time()
+            trained = []
+
+            with self.reader() as db:
+                c = db.cursor()
+                c.execute("SELECT type, COUNT(*) FROM Headers GROUP BY type")
+                types = [t for t, count in c.fetchall() if self.zdicts.needs_training(t, count, now)]
+
+                samples = {}
+                for type in types:
+                    c.execute("SELECT d.body, d.dict_id FROM Documents d JOIN Headers h ON d.id = h.id WHERE h.type = ? ORDER BY h.rev DESC LIMIT ?", (type, self.zdicts.max_samples, ))
+                    samples[type] = [self.zdicts.decompress(body, dict_id) for body, dict_id in c.fetchall()]
+                c.close()
 
-                # not that we ever overflow it ...
-                rev = (rev + 1) & ((2**63)-1)
+            for type, bodies in samples.items():
+                self.zdicts.checked[type] = now
+                zdict = self.zdicts.retrain(type, bodies)
+                if zdict is None:
+                    trained.append((type, None, 0, len(bodies), ))
+                    continue
 
-                # create the header and update the body
-                header = self.make_header(doc, rev=rev, write_back=True)
-                body = zlib.compress( json.dumps(doc).encode("utf-8") )
+                with self.lock, self.conn as db:
+                    c = db.execute("INSERT INTO Dictionaries (type, created, zdict) VALUES (?, ?, ?)", (type, now, sqlite3.Binary(zdict), ))
+                    self.zdicts.add(c.lastrowid, type, now, zdict)
 
-                db.execute("INSERT OR REPLACE INTO Headers (id, rev, timestamp, type, hostname, tag, run) VALUES (?, ?, ?, ?, ?, ?, ?)", (
-                    header.get("_id"),
-                    header.get("_rev"),
-                    header.get("timestamp"),
-                    header.get("type"),
-                    header.get("hostname"),
-                    header.get("tag"),
-                    header.get("run"),
-                ))
+                trained.append((type, c.lastrowid, len(zdict), len(bodies), ))
 
-                db.execute("INSERT OR REPLACE INTO Documents (id, rev, body) VALUES (?, ?, ?)", (
-                    header.get("_id"),
-                    header.get("_rev"),
-                    sqlite3.Binary(body),
-                ))
+            with self.lock, self.conn as db:
+                pruned = self.zdicts.prune(db)
 
-                headers.append(header)
+            return trained, pruned
 
-        self.update_headers(headers)
+        trained, pruned = self.executor.run(train)
+        for type, dict_id, size, n in trained:
+            if dict_id is None:
+                log.info("Kept the dictionary for type %s, a new one would not compress better (%d samples).", type, n)
+            else:
+                log.info("Trained dictionary %d for type %s (%d bytes, %d samples).", dict_id, type, size, n)
+
+        if pruned:
+            log.info("Deleted %d unused dictionaries.", len(pruned))
+
+    def run_dictionary_greenlet(self, interval=3600):
+        while True:
+            try:
+                self.train_dictionaries()
+            except:
+                log.warning("Failed to train compression dictionaries.", exc_info=True)
+
+            gevent.sleep(interval)
+
+    def drop_ids(self, ids):
+        def delete():
+            with self.lock, self.conn as db:
+                rows = [(id, ) for id in ids]
+                db.executemany("DELETE FROM Headers WHERE id= ?", rows)
+                db.executemany("DELETE FROM Documents WHERE id= ?", rows)
+
+        self.executor.run(delete)
+        for id in ids:
+            self.index.remove(id)
+
+            if self.dedup is not None:
+                self.dedup.forget(id)
+
+            if self.cache is not None:
+                self.cache.invalidate(id)
+
+            if self.deltas is not None:
+                self.deltas.forget(id)
 
     def add_listener(self, listener):
         self.listeners.append(listener)
@@ -209,8 +1442,549 @@ class Database(object):
             return
 
         copy = list(self.listeners)
-        for client in copy:
-            client.updateHeaders(headers)
+        self.broadcast.send(copy, headers)
+
+        event, self.rev_changed = self.rev_changed, gevent.event.Event()
+        event.set()
+
+    def wait_for_rev(self, rev, timeout, filter=None):
+        # parks the calling greenlet until there is a header newer than rev
+        # (and matching the filter), returns False on timeout
+        deadline = time.time() + timeout
+
+        self.rev_waiters += 1
+        try:
+            while True:
+                headers = self.index.since(rev)
+                if filter is not None:
+                    headers = filter.apply(headers)
+
+                if headers:
+                    return True
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+
+                self.rev_changed.wait(remaining)
+        finally:
+            self.rev_waiters -= 1
+
+class IngestQueue(object):
+    """
+        Group-commits the uploaded documents.
+
+        A group is committed when it reaches max_size documents,
+        or max_delay seconds after its first document arrived.
+        Each commit results in a single update_headers broadcast.
+
+        Every upload (submission) gets the result of its own commit:
+        if a group fails, its submissions are committed one by one,
+        so a bad document only fails the upload it came with.
+        Uploads wait (up to max_wait seconds) while more than
+        max_pending documents are queued.
+    """
+
+    def __init__(self, db, max_delay=0.05, max_size=1000, max_pending=10000, max_wait=5):
+        self.db = db
+        self.max_delay = max_delay
+        self.max_size = max_size
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+
+        self.pending = [] # (documents, AsyncResult)
+        self.pending_docs = 0
+        self.has_pending = gevent.event.Event()
+        self.is_full = gevent.event.Event()
+        self.has_room = gevent.event.Event()
+        self.has_room.set()
+
+        self.received = 0
+        self.committed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.retries = 0
+        self.commits = 0
+        self.commit_time = 0.
+        self.commit_time_max = 0.
+        self.commit_time_last = 0.
+
+    def submit(self, documents):
+        """
+            Returns an AsyncResult, set once the documents are committed,
+            or None if the queue stayed full for max_wait seconds.
+        """
+        deadline = time.time() + self.max_wait
+        while self.pending_docs >= self.max_pending:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self.has_room.wait(remaining):
+                self.rejected += len(documents)
+                return None
+
+        result = gevent.event.AsyncResult()
+        self.pending.append((documents, result, ))
+        self.pending_docs += len(documents)
+        self.received += len(documents)
+
+        if self.pending_docs >= self.max_pending:
+            self.has_room.clear()
+
+        self.has_pending.set()
+        if self.pending_docs >= self.max_size:
+            self.is_full.set()
+
+        return result
+
+    def _commit(self, submissions):
+        docs = [doc for documents, result in submissions for doc in documents]
+        self.db.direct_transactional_upload(docs)
+
+        self.committed += len(docs)
+        for documents, result in submissions:
+            result.set(len(documents))
+
+    def _fail(self, submission, e):
+        documents, result = submission
+        self.failed += len(documents)
+        log.warning("Failed to commit %d document(s).", len(documents), exc_info=True)
+        result.set_exception(e)
+
+    def flush(self):
+        # submissions are not split between groups
+        batch, size = [], 0
+        while self.pending and (not batch or size + len(self.pending[0][0]) <= self.max_size):
+            batch.append(self.pending.pop(0))
+            size += len(batch[-1][0])
+
+        self.pending_docs -= size
+        if self.pending_docs < self.max_size:
+            self.is_full.clear()
+        if self.pending_docs < self.max_pending:
+            self.has_room.set()
+        if not self.pending:
+            self.has_pending.clear()
+
+        if not batch:
+            return
+
+        started = time.time()
+        try:
+            self._commit(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                self._fail(batch[0], e)
+            else:
+                log.warning("Failed to commit a group of %d document(s), committing the uploads separately.", size, exc_info=True)
+
+                for submission in batch:
+                    self.retries += 1
+                    try:
+                        self._commit([submission])
+                    except Exception as e:
+                        self._fail(submission, e)
+
+        t = time.time() - started
+        self.commits += 1
+        self.commit_time += t
+        self.commit_time_last = t
+        self.commit_time_max = max(self.commit_time_max, t)
+
+    def run_greenlet(self):
+        while True:
+            self.has_pending.wait()
+
+            # give the others some time to join the group
+            self.is_full.wait(timeout=self.max_delay)
+            self.flush()
+
+    def stats(self):
+        return {
+            'queue_depth': self.pending_docs,
+            'submissions': len(self.pending),
+            'received': self.received,
+            'committed': self.committed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'retries': self.retries,
+            'commits': self.commits,
+            'commit_time_avg': self.commit_time / max(self.commits, 1),
+            'commit_time_max': self.commit_time_max,
+            'commit_time_last': self.commit_time_last,
+        }
+
+class RetentionEngine(object):
+    """
+        Deletes expired documents in the background.
+
+        ttl maps a document type to the max age (in seconds, by header timestamp),
+        host_cap maps a document type to the max number of documents kept per hostname
+        (the oldest revisions go first). Types not listed are kept forever.
+
+        Rows are deleted in small transactions, so uploads are not blocked for long,
+        and the free pages are given back with incremental_vacuum.
+        That requires a database with auto_vacuum=INCREMENTAL, older databases
+        have to be converted offline (utils/enable_incremental_vacuum.py),
+        until then the space is only reused by new rows.
+    """
+
+    def __init__(self, db, ttl=None, host_cap=None, batch_size=500, vacuum_pages=256):
+        self.db = db
+        self.ttl = ttl or {}
+        self.host_cap = host_cap or {}
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+
+        self.incremental = False
+
+        self.deleted = 0
+        self.reclaimed = 0
+        self.last_run = None
+        self.last_run_time = 0.
+
+    def _query(self, sql, args=()):
+        def query():
+            with self.db.reader() as db:
+                c = db.cursor()
+                c.execute(sql, args)
+                r = c.fetchall()
+                c.close()
+
+            return r
+
+        return self.db.executor.run(query)
+
+    def _writer_pragma(self, pragma):
+        def run():
+            with self.db.lock:
+                c = self.db.conn.cursor()
+                r = c.execute(pragma).fetchall()
+                c.close()
+
+            return r
+
+        return self.db.executor.run(run)
+
+    def expired_batches(self, now):
+        for type, ttl in self.ttl.items():
+            while True:
+                ids = self._query("SELECT id FROM Headers WHERE type = ? AND timestamp < ? LIMIT ?", (type, now - ttl, self.batch_size, ))
+                if not ids:
+                    break
+
+                yield [x[0] for x in ids]
+
+        for type, cap in self.host_cap.items():
+            over = self._query("SELECT hostname, COUNT(*) FROM Headers WHERE type = ? GROUP BY hostname HAVING COUNT(*) > ?", (type, cap, ))
+            for hostname, count in over:
+                excess = count - cap
+                while excess > 0:
+                    ids = self._query("SELECT id FROM Headers WHERE type = ? AND hostname IS ? ORDER BY rev ASC LIMIT ?", (type, hostname, min(excess, self.batch_size), ))
+                    if not ids:
+                        break
+
+                    excess -= len(ids)
+                    yield [x[0] for x in ids]
+
+    def check_incremental_vacuum(self):
+        # the conversion rewrites the whole database (VACUUM), it is not done here
+        self.incremental = self._writer_pragma("PRAGMA auto_vacuum")[0][0] == 2
+        if not self.incremental:
+            log.info("Database does not use auto_vacuum=INCREMENTAL, free pages will not be given back "
+                "(convert it offline with utils/enable_incremental_vacuum.py).")
+
+    def vacuum(self):
+        if not self.incremental:
+            return 0
+
+        page_size = self._writer_pragma("PRAGMA page_size")[0][0]
+        page_count = self._writer_pragma("PRAGMA page_count")[0][0]
+        before = page_count
+
+        while self._writer_pragma("PRAGMA freelist_count")[0][0] > 0:
+            self._writer_pragma("PRAGMA incremental_vacuum(%d)" % self.vacuum_pages)
+
+            last, page_count = page_count, self._writer_pragma("PRAGMA page_count")[0][0]
+            if page_count == last:
+                # auto_vacuum is not enabled
+                break
+
+            gevent.sleep(0)
+
+        return (before - page_count) * page_size
+
+    def run_once(self):
+        started = time.time()
+        deleted = 0
+
+        for ids in self.expired_batches(started):
+            self.db.drop_ids(ids)
+            deleted += len(ids)
+
+            # let the others in between the batches
+            gevent.sleep(0.1)
+
+        reclaimed = self.vacuum()
+
+        self.deleted += deleted
+        self.reclaimed += reclaimed
+        self.last_run = started
+        self.last_run_time = time.time() - started
+
+        if deleted or reclaimed:
+            log.info("Retention: deleted %d documents, reclaimed %d bytes in %.2f seconds.", deleted, reclaimed, self.last_run_time)
+
+    def run_greenlet(self, interval=600):
+        if self.db.db_str == ":memory:":
+            return
+
+        try:
+            self.check_incremental_vacuum()
+        except:
+            log.warning("Failed to check the auto_vacuum mode.", exc_info=True)
+
+        while True:
+            try:
+                self.run_once()
+            except:
+                log.warning("Retention run failed.", exc_info=True)
+
+            gevent.sleep(interval)
+
+    def stats(self):
+        return {
+            'ttl': self.ttl,
+            'host_cap': self.host_cap,
+            'incremental_vacuum': self.incremental,
+            'deleted': self.deleted,
+            'reclaimed_bytes': self.reclaimed,
+            'last_run': self.last_run,
+            'last_run_time': self.last_run_time,
+        }
+
+class HeaderFilter(object):
+    """
+        Server side subscription filter, sent by the client in sync_request:
+            { "type": [...], "hostname": [...], "tag": [...], "run": [min, max], "id_prefix": [...] }
+
+        All keys are optional, lists can be replaced with a single value
+        and either end of the run range can be null.
+
+        The spec comes from the client, it is checked here (ValueError),
+        match() runs on the upload path and must not fail.
+    """
+
+    KEYS = ("type", "hostname", "tag", "run", "id_prefix", )
+
+    def __init__(self, spec):
+        if not isinstance(spec, dict):
+            raise ValueError("filter must be an object")
+
+        unknown = set(spec) - set(self.KEYS)
+        if unknown:
+            raise ValueError("unknown filter keys: %s" % ", ".join(sorted(unknown)))
+
+        def as_strings(key):
+            v = spec.get(key, None)
+            if v is None:
+                return None
+            if not isinstance(v, list):
+                v = [v]
+            if not all(isinstance(x, str) for x in v):
+                raise ValueError("filter %s must be a string or a list of strings" % key)
+            return v
+
+        def as_run(v):
+            if v is None:
+                return None
+            if isinstance(v, bool) or not isinstance(v, int):
+                raise ValueError("filter run bounds must be integers or null")
+            return v
+
+        self.types = as_strings("type")
+        self.hostnames = as_strings("hostname")
+        self.tags = as_strings("tag")
+
+        if self.types is not None:
+            self.types = set(self.types)
+        if self.hostnames is not None:
+            self.hostnames = set(self.hostnames)
+        if self.tags is not None:
+            self.tags = set(self.tags)
+
+        self.run = spec.get("run", None)
+        if self.run is not None:
+            if not isinstance(self.run, list):
+                self.run = [self.run, self.run]
+            if len(self.run) != 2:
+                raise ValueError("filter run must be a number or a [min, max] range")
+            self.run = [as_run(x) for x in self.run]
+
+        self.id_prefix = as_strings("id_prefix")
+        if self.id_prefix is not None:
+            self.id_prefix = tuple(self.id_prefix)
+
+        # identical filters share the encoded frames
+        self.key = json.dumps(spec, sort_keys=True)
+
+    @classmethod
+    def create(cls, spec):
+        if not spec:
+            return None
+
+        return cls(spec)
+
+    def match(self, header):
+        if self.types is not None and header["type"] not in self.types:
+            return False
+
+        if self.hostnames is not None and header["hostname"] not in self.hostnames:
+            return False
+
+        if self.tags is not None and header["tag"] not in self.tags:
+            return False
+
+        if self.run is not None:
+            run = header["run"]
+            if not isinstance(run, (int, float)):
+                return False
+            if self.run[0] is not None and run < self.run[0]:
+                return False
+            if self.run[1] is not None and run > self.run[1]:
+                return False
+
+        if self.id_prefix is not None and not header["_id"].startswith(self.id_prefix):
+            return False
+
+        return True
+
+    def apply(self, headers):
+        return [h for h in headers if self.match(h)]
+
+class SendQueue(object):
+    """
+        Bounded outgoing queue of a single websocket client.
+
+        Entries are lists: ["headers", headers, frames, extra], ["snapshot", headers, extra, cache_key],
+        ["frame", data, binary] or ["resync"].
+
+        Once more than max_entries header updates are waiting, they are coalesced
+        into a single update with the latest rev of every id.
+        If that is still more than max_headers, the updates are dropped
+        and the client is resynchronized from the last rev it received (acked_rev).
+
+        Other entries (snapshots and frames, ie answers to request_documents) can't be dropped,
+        once more than max_entries of them or max_bytes of frames are waiting,
+        the queue is overflowed and put() returns False (the client is disconnected).
+    """
+
+    def __init__(self, max_entries=64, max_headers=10000, max_bytes=64*1024*1024):
+        self.max_entries = max_entries
+        self.max_headers = max_headers
+        self.max_bytes = max_bytes
+
+        self.entries = collections.deque()
+        self.ready = gevent.event.Event()
+
+        # not counting the "headers" entries
+        self.others = 0
+        self.queued_bytes = 0
+        self.overflowed = False
+
+        self.acked_rev = None
+        self.sent_frames = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.resyncs = 0
+
+    def _updates(self):
+        return [e for e in self.entries if e[0] == "headers"]
+
+    def put(self, entry):
+        if self.overflowed:
+            return False
+
+        self.entries.append(entry)
+        self.ready.set()
+
+        if entry[0] == "headers":
+            if len(self._updates()) > self.max_entries:
+                self.coalesce()
+
+            return True
+
+        self.others += 1
+        if entry[0] == "frame":
+            self.queued_bytes += len(entry[1])
+
+        if self.others > self.max_entries or self.queued_bytes > self.max_bytes:
+            self.overflowed = True
+            self.clear()
+            return False
+
+        return True
+
+    def coalesce(self):
+        updates = self._updates()
+        total = sum(len(e[1]) for e in updates)
+
+        latest = {}
+        for e in updates:
+            for h in e[1]:
+                old = latest.get(h["_id"], None)
+                if old is None or old["_rev"] < h["_rev"]:
+                    latest[h["_id"]] = h
+
+        self.entries = collections.deque(e for e in self.entries if e[0] != "headers")
+        self.coalesced += 1
+        self.dropped += total - len(latest)
+
+        if len(latest) > self.max_headers:
+            # too far behind, start over from what it has
+            self.dropped += len(latest)
+            self.resyncs += 1
+
+            if not any(e[0] == "resync" for e in self.entries):
+                self.entries.append(["resync"])
+                self.others += 1
+            return
+
+        headers = sorted(latest.values(), key=lambda h: h["_rev"])
+        self.entries.append(["headers", headers, None, {}])
+
+    def get(self):
+        while not self.entries:
+            self.ready.clear()
+            self.ready.wait()
+
+        entry = self.entries.popleft()
+        if entry[0] != "headers":
+            self.others -= 1
+        if entry[0] == "frame":
+            self.queued_bytes -= len(entry[1])
+
+        return entry
+
+    def clear(self):
+        self.entries.clear()
+        self.others = 0
+        self.queued_bytes = 0
+
+    def ack(self, rev):
+        if rev is not None and (self.acked_rev is None or rev > self.acked_rev):
+            self.acked_rev = rev
+
+    def stats(self):
+        return {
+            'queue_depth': len(self.entries),
+            'queued_bytes': self.queued_bytes,
+            'overflowed': self.overflowed,
+            'pending_headers': sum(len(e[1]) for e in self.entries if e[0] in ("headers", "snapshot", )),
+            'acked_rev': self.acked_rev,
+            'sent_frames': self.sent_frames,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'resyncs': self.resyncs,
+        }
 
 class SyncSocket(WebSocket):
     STATE_NONE      = 1
@@ -218,10 +1992,42 @@ class SyncSocket(WebSocket):
     STATE_LISTEN    = 3
     STATE_CLOSED    = -1
 
+    # max documents a client can subscribe to (see pushDocuments)
+    max_subscriptions = 1000
+
+    # header encodings a client can ask for (see encode_header_frames)
+    FORMATS = ("columns", )
+
+    # set for http (proxy mode) clients, they can't receive binary frames
+    is_proxy = False
+
+    # initial sync only covers this many seconds (unless the client asks otherwise)
+    sync_horizon = None
+
     def opened(self):
-        self.backlog = []
         self.state = self.STATE_NONE
         self.close_reason = None
+        self.filter = None
+        self.format = None
+
+        # where the initial sync started (the horizon), resyncs start there
+        # if the client did not get anything yet
+        self.sync_from_rev = None
+
+        # document ids whose new bodies are pushed with the headers
+        # and the revs we pushed (deltas are sent against those)
+        self.subscribed = set()
+        self.pushed_revs = {}
+        self.pushed_documents = 0
+        self.pushed_deltas = 0
+
+        # all outgoing messages go through the queue and the sender greenlet,
+        # so a slow client does not slow down the uploads
+        # (proxy mode sends everything directly)
+        self.queue = SendQueue()
+        self.sender = None
+        if not self.is_proxy:
+            self.sender = gevent.spawn(self.run_sender)
 
         self.db.add_listener(self)
 
@@ -229,10 +2035,153 @@ class SyncSocket(WebSocket):
 
     def closed(self, code, reason=None, output_log=True):
         self.db.remove_listener(self)
+        self.subscribe([])
+
+        if self.sender is not None:
+            self.sender.kill(block=False)
 
         if output_log:
             log.info("WebSocket disconnected: %s code=%s reason=%s", self.peer_address, code, reason)
 
+    def enqueue(self, entry):
+        if self.sender is None:
+            self.deliver(entry)
+        elif not self.queue.put(entry) and self.state != self.STATE_CLOSED:
+            log.warning("WebSocket client (%s) is too slow, its queue is full, disconnecting.", self.peer_address)
+            self.state = self.STATE_CLOSED
+            self.drop_connection()
+
+    def drop_connection(self):
+        # the sender is most likely blocked writing to this socket,
+        # a close frame can't be sent from another greenlet (concurrent use),
+        # so the sender is stopped and the socket shut down,
+        # the reader then sees the end of the stream and terminates the websocket
+        self.sender.kill(block=False)
+        self.server_terminated = True
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, AttributeError):
+            pass
+
+    def deliver(self, entry):
+        kind = entry[0]
+
+        if kind == "frame":
+            self.send(entry[1], entry[2])
+            self.queue.sent_frames += 1
+        elif kind == "resync":
+            from_rev = self.queue.acked_rev
+            if from_rev is None:
+                from_rev = self.sync_from_rev
+
+            log.info("WebSocket client (%s) is too slow, resynchronizing from rev %s", self.peer_address, from_rev)
+            self.deliver(self.makeSnapshot(from_rev=from_rev))
+        elif kind == "snapshot" and entry[1]:
+            headers, extra, (version, key) = entry[1:]
+            frames = self.db.broadcast.snapshot(version, key, headers, format=self.format, **extra)
+
+            # the snapshot is encoded and sent in chunks,
+            # let uploads and other clients run in between
+            for frame in frames:
+                self.sendFrames([frame])
+                if self.sender is not None:
+                    gevent.sleep(0)
+
+            if not extra.get("older", False):
+                self.queue.ack(headers[-1]["_rev"])
+        elif kind == "headers" and entry[1]:
+            headers, frames, extra = entry[1:]
+            if frames is None:
+                frames = self.db.broadcast.encode(headers, format=self.format, **extra)
+
+            pushed = [h for h in headers if h["_id"] in self.subscribed]
+            if pushed:
+                frames = self.pushDocuments(frames, pushed)
+
+            self.sendFrames(frames)
+            if not extra.get("older", False):
+                self.queue.ack(headers[-1]["_rev"])
+
+    def subscribe(self, ids):
+        ids = set(ids)
+
+        if self.db.deltas is not None:
+            self.db.deltas.untrack(self.subscribed - ids)
+            self.db.deltas.track(ids - self.subscribed)
+
+        for id in self.subscribed - ids:
+            self.pushed_revs.pop(id, None)
+
+        self.subscribed = ids
+
+    def pushDocuments(self, frames, headers):
+        # subscribed documents are spliced into the last frame, as "documents",
+        # or as "deltas" against the rev we pushed before
+        # (frames are shared with other clients, so the frame is copied)
+        deltas = []
+        ids = []
+        for h in headers:
+            delta = None
+            if self.db.deltas is not None:
+                delta = self.db.deltas.get(h["_id"], self.pushed_revs.get(h["_id"], None), h["_rev"])
+
+            if delta is not None:
+                deltas.append(delta)
+                self.pushed_revs[h["_id"]] = h["_rev"]
+            else:
+                ids.append(h["_id"])
+
+        docs = []
+        if ids:
+            docs = self.db.get_document_bodies(ids)
+
+        # the client has the rev of the body we send (which can be newer),
+        # documents that were not found are not pushed
+        for body in docs:
+            doc = json.loads(body)
+            self.pushed_revs[doc["_id"]] = doc["_rev"]
+
+        if not docs and not deltas:
+            return frames
+
+        self.pushed_documents += len(docs)
+        self.pushed_deltas += len(deltas)
+
+        last = frames[-1][:-1]
+        if docs:
+            last += b', "documents": [' + b", ".join(docs) + b']'
+        if deltas:
+            last += b', "deltas": [' + b", ".join(deltas) + b']'
+
+        return frames[:-1] + [last + b'}']
+
+    def run_sender(self):
+        try:
+            while True:
+                self.deliver(self.queue.get())
+        except gevent.GreenletExit:
+            pass
+        except:
+            log.warning("WebSocket (%s) sender failed.", self.peer_address, exc_info=True)
+
+    def stats(self):
+        r = self.queue.stats()
+        r["peer"] = str(self.peer_address)
+        r["state"] = self.state
+        r["filter"] = self.filter and self.filter.key
+        r["format"] = self.format
+        r["subscribed"] = len(self.subscribed)
+        r["pushed_documents"] = self.pushed_documents
+        r["pushed_deltas"] = self.pushed_deltas
+
+        deflate = getattr(getattr(self, "stream", None), "deflate", None)
+        if deflate is not None:
+            r["deflate_in"] = deflate.bytes_in
+            r["deflate_out"] = deflate.bytes_out
+
+        return r
+
     def received_message(self, msg):
         #print "recv:", self, msg, type(msg)
         #sys.stdout.flush()
@@ -240,87 +2189,177 @@ class SyncSocket(WebSocket):
         jsn = json.loads(msg.data)
         if jsn["event"] == "sync_request":
             known_rev = jsn.get("known_rev", None)
+            horizon = jsn.get("horizon", self.sync_horizon)
+            try:
+                self.filter = HeaderFilter.create(jsn.get("filter", None))
+            except ValueError as e:
+                log.warning("WebSocket client (%s) sent an invalid filter: %s", self.peer_address, e)
+                self.enqueue(["frame", json.dumps({ 'event': 'sync_error', 'error': "invalid filter: %s" % e }), False])
+                return
+            self.format = jsn.get("format", None) if jsn.get("format", None) in self.FORMATS else None
             self.state = self.STATE_INSYNC
 
-            log.info("WebSocket client (%s) requested sync from rev %s", self.peer_address, known_rev)
+            log.info("WebSocket client (%s) requested sync from rev %s (horizon %s, filter %s)", self.peer_address, known_rev, horizon,
+                self.filter and self.filter.key)
 
             # if know_rev is not zero, we have to send at least a single header
             # to let the web interface to know it is synchronized
+            # (only the snapshots of fresh clients are shared)
+            shared = known_rev is None
             if known_rev is not None:
                 known_rev = int(known_rev) - 1
+            elif horizon:
+                # fresh client, only send the recent headers
+                first_rev = self.db.find_first_rev(float(horizon))
+                if first_rev is None and self.db.index.last_rev is not None:
+                    # nothing new inside the horizon, everything is older
+                    first_rev = self.db.index.last_rev + 1
+
+                if first_rev is not None:
+                    known_rev = first_rev - 1
+                else:
+                    known_rev = self.db.index.last_rev
 
+                self.sendSyncWindow(first_rev)
 
             # send the current state
-            # if any changes happen during this time
-            # they go into backlog
-            self.backlog.insert(0, self.db.get_headers(from_rev=known_rev))
-            while len(self.backlog):
-                h = self.backlog.pop(0)
-                self.sendHeaders(h)
-
+            # changes made before this point are part of the index (and the snapshot),
+            # changes made after are queued behind it
+            self.sync_from_rev = known_rev
+            snapshot = self.makeSnapshot(from_rev=known_rev, shared=shared)
+            if not snapshot[1]:
+                self.sendSyncMarker(self.db.index.last_rev)
+
+            self.enqueue(snapshot)
             self.state = self.STATE_LISTEN
 
-        if jsn["event"] == "request_documents":
-            ids = set(jsn["ids"])
-
-            with self.db.conn as db:
-                c = db.cursor()
+        if jsn["event"] == "request_older":
+            # headers left out by the sync horizon
+            before_rev = int(jsn["before_rev"])
 
-                IN = "(" + ",".join("?"*len(ids)) + ")"
-                c.execute("SELECT * FROM Documents WHERE id IN " + IN, list(ids))
+            log.info("WebSocket client (%s) requested headers older than rev %s", self.peer_address, before_rev)
 
-                docs = list(self.db.prepare_docs(c))
-                c.close()
+            self.enqueue(self.makeSnapshot(to_rev=before_rev - 1, shared=True, older=True))
+            self.sendSyncWindow(None)
 
-            jsn = json.dumps({
-                'event': 'update_documents',
-                'documents': docs,
-            }).encode("utf8")
+        if jsn["event"] == "subscribe_documents":
+            # replaces the previous subscription
+            ids = jsn.get("ids", [])
+            self.subscribe(ids[:self.max_subscriptions])
 
-            log.info("WebSocket client (%s) requested %d documents (%d bytes)", self.peer_address, len(ids), len(jsn))
-            self.send(jsn, False)
+            log.info("WebSocket client (%s) subscribed to %d documents", self.peer_address, len(self.subscribed))
 
-    def sendHeaders(self, headers):
-        if not headers:
-            return
+        if jsn["event"] == "request_documents":
+            ids = set(jsn["ids"])
 
-        # split sending into multiple messages
-        # this should be extremely helpful with users on bad connections
-        cp = list(headers)
+            if jsn.get("encoding", None) == "deflate" and not self.is_proxy:
+                docs = self.db.get_document_bodies(ids, encoding="deflate")
+                frame = self.makeDeflateFrame(docs)
+                binary = True
+            else:
+                # stored json is spliced into the frame as it is
+                docs = self.db.get_document_bodies(ids)
+                frame = b'{"event": "update_documents", "documents": [' + b", ".join(docs) + b']}'
+                binary = False
+
+            log.info("WebSocket client (%s) requested %d documents (%d bytes)", self.peer_address, len(ids), len(frame))
+            self.enqueue(["frame", frame, binary])
+
+    def makeDeflateFrame(self, docs):
+        # binary frame: 4 byte (big-endian) length of the json part, the json part,
+        # followed by the zlib streams, their sizes are listed in "parts"
+        # documents which can't be passed as stored (ie, compressed with a preset dictionary)
+        # are sent in "documents" as usual
+        parts = [body for is_deflate, body in docs if is_deflate]
+        plain = [body for is_deflate, body in docs if not is_deflate]
+
+        head = b'{"event": "update_documents", "encoding": "deflate", "parts": ' + json.dumps([len(p) for p in parts]).encode("utf-8")
+        head += b', "documents": [' + b", ".join(plain) + b']}'
+
+        return struct.pack(">I", len(head)) + head + b"".join(parts)
+
+    def makeSnapshot(self, from_rev=None, to_rev=None, shared=False, **extra):
+        # headers are taken now, the frames are encoded by the sender
+        # (or taken from the cache, if another client asked for the same thing,
+        # only shared snapshots are cached, see HeaderBroadcast)
+        version = self.db.index.version
+        headers = self.filterHeaders(self.db.get_headers(from_rev=from_rev, to_rev=to_rev))
+
+        key = None
+        if shared:
+            key = (from_rev, to_rev, self.filter and self.filter.key, self.format, json.dumps(extra, sort_keys=True), )
+
+        return ["snapshot", headers, extra, (version, key, )]
+
+    def filterHeaders(self, headers):
+        if self.filter is None:
+            return headers
+
+        return self.filter.apply(headers)
+
+    def sendSyncWindow(self, first_rev):
+        # tells the client that older headers (rev < first_rev) are available on request
+        self.enqueue(["frame", json.dumps({
+            'event': 'sync_window',
+            'first_rev': first_rev,
+            'older_available': first_rev is not None and self.db.index.first_rev < first_rev,
+        }), False])
+
+    def sendSyncMarker(self, rev):
+        # an empty update, lets the client know it is synchronized
+        self.enqueue(["frame", json.dumps({
+            'event': 'update_headers',
+            'rev': [rev, rev],
+            'sync_to_rev': rev,
+            'headers': [],
+
+            'total_sent': 0,
+            'total_avail': 0,
+        }), False])
+
+    def sendFrames(self, frames):
+        for frame in frames:
+            self.send(frame, False)
+            self.queue.sent_frames += 1
+
+    def updateHeaders(self, headers, frames=None):
+        # this cannot throw
+        # or it will kill the input server
 
-        total_avail = len(cp)
-        total_sent = 0
+        # headers are already filtered (see HeaderBroadcast)
+        # and frames, if given, are shared with other clients
 
-        max_size = 1000
-        last_rev = cp[-1]["_rev"]
+        # before the sync (and during it), updates are not needed:
+        # they will be a part of the snapshot
+        try:
+            if self.state == self.STATE_LISTEN:
+                self.enqueue(["headers", headers, frames, {}])
+        except:
+            log.warning("WebSocket error.", exc_info=True)
 
-        while cp:
-            to_send, cp = cp[:max_size], cp[max_size:]
-            total_sent += len(to_send)
+    @staticmethod
+    def proxy_wait(input_messages, timeout):
+        # long-poll: a sync_request from a client which is already synchronized
+        # is held until there is something new to send (or the timeout)
+        # (a new client waits only if there is nothing to send at all)
+        for msg in input_messages:
+            jsn = json.loads(msg)
+            if jsn.get("event") != "sync_request":
+                continue
 
-            self.send(json.dumps({
-                'event': 'update_headers',
-                'rev': [to_send[0]["_rev"], to_send[-1]["_rev"]],
-                'sync_to_rev': last_rev,
-                'headers': to_send,
+            known_rev = jsn.get("known_rev", None)
+            if known_rev is not None:
+                known_rev = int(known_rev)
 
-                'total_sent': total_sent,
-                'total_avail': total_avail,
-            }), False)
+            try:
+                f = HeaderFilter.create(jsn.get("filter", None))
+            except ValueError:
+                # answered right away, with the error (see proxy_mode)
+                return True
 
-    def updateHeaders(self, headers):
-        # this cannot throw
-        # or it will kill the input server
+            return SyncSocket.db.wait_for_rev(known_rev, timeout, filter=f)
 
-        try:
-            if self.state == self.STATE_INSYNC:
-                self.backlog.append(headers)
-            elif self.state == self.STATE_LISTEN:
-                self.sendHeaders(headers)
-            else:
-                pass
-        except:
-            log.warning("WebSocket error.", exc_info=True)
+        return True
 
     @staticmethod
     def proxy_mode(input_messages, peer_address):
@@ -333,10 +2372,15 @@ class SyncSocket(WebSocket):
         output_messages = []
 
         class Proxy(SyncSocket):
+            is_proxy = True
+
             def __init__(self, peer_address):
                 self._peer_address = peer_address
 
             def send(self, msg, binary=False):
+                if isinstance(msg, bytes):
+                    msg = msg.decode("utf-8")
+
                 output_messages.append(msg)
 
             @property
@@ -356,14 +2400,567 @@ class SyncSocket(WebSocket):
 
         return output_messages
 
+class UpstreamConnection(http.client.HTTPConnection):
+    # the same, but on a gevent socket (we don't monkey patch)
+    def connect(self):
+        self.sock = gevent.socket.create_connection((self.host, self.port), self.timeout, self.source_address)
+
+class UpstreamPool(object):
+    """
+        Keep-alive http connections to the other nodes, used by /redirect.
+
+        Requests only block their own greenlet (see UpstreamConnection).
+        Concurrent requests to a node are limited by max_per_upstream,
+        except the long-polls, which are parked upstream and would hold a slot
+        for the whole wait.
+        Identical requests share a single fetch, its result is kept for cache_ttl seconds.
+    """
+
+    def __init__(self, max_per_upstream=8, max_idle=4, cache_ttl=1.0):
+        self.max_per_upstream = max_per_upstream
+        self.max_idle = max_idle
+        self.cache_ttl = cache_ttl
+
+        self.idle = {} # upstream -> [connection]
+        self.limits = {} # upstream -> semaphore
+        self.inflight = {} # key -> AsyncResult
+        self.cache = {} # key -> (expires, result)
+
+        self.requests = 0
+        self.fetches = 0
+        self.long_polls = 0
+        self.shared = 0
+        self.cache_hits = 0
+        self.connections = 0
+        self.errors = 0
+
+    def _acquire(self, upstream, timeout):
+        conns = self.idle.get(upstream, [])
+        if conns:
+            conn = conns.pop()
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+
+            return conn, True
+
+        host, port = upstream
+        self.connections += 1
+        return UpstreamConnection(host, port, timeout=timeout), False
+
+    def _release(self, upstream, conn):
+        conns = self.idle.setdefault(upstream, [])
+        if len(conns) < self.max_idle:
+            conns.append(conn)
+        else:
+            conn.close()
+
+    def _fetch(self, upstream, path, body, content_type, timeout, long_poll):
+        if long_poll:
+            self.long_polls += 1
+            return self._request(upstream, path, body, content_type, timeout)
+
+        limit = self.limits.get(upstream, None)
+        if limit is None:
+            limit = self.limits[upstream] = gevent.lock.BoundedSemaphore(self.max_per_upstream)
+
+        with limit:
+            return self._request(upstream, path, body, content_type, timeout)
+
+    def _request(self, upstream, path, body, content_type, timeout):
+        self.fetches += 1
+
+        # an idle connection might have been closed by the other side,
+        # in that case, try once more on a new one
+        while True:
+            conn, reused = self._acquire(upstream, timeout)
+            try:
+                conn.request("POST", path, body=body, headers={ "Content-Type": content_type })
+                r = conn.getresponse()
+                result = (r.status, r.getheader("Content-Type", "application/json"), r.read(), )
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if reused:
+                    continue
+
+                raise
+            except:
+                conn.close()
+                raise
+
+            if r.will_close:
+                conn.close()
+            else:
+                self._release(upstream, conn)
+
+            return result
+
+    def post(self, host, port, path, body, content_type="application/json", timeout=5, long_poll=False):
+        """
+            Returns (status, content_type, body) of the response.
+            long_poll requests are not counted against max_per_upstream.
+        """
+        self.requests += 1
+
+        upstream = (host, int(port), )
+        key = (upstream, path, body, )
+        now = time.time()
+
+        cached = self.cache.get(key, None)
+        if cached is not None and cached[0] > now:
+            self.cache_hits += 1
+            return cached[1]
+
+        pending = self.inflight.get(key, None)
+        if pending is not None:
+            self.shared += 1
+            return pending.get()
+
+        pending = self.inflight[key] = gevent.event.AsyncResult()
+        try:
+            result = self._fetch(upstream, path, body, content_type, timeout, long_poll)
+        except Exception as e:
+            self.errors += 1
+            pending.set_exception(e)
+            raise
+        finally:
+            del self.inflight[key]
+
+        pending.set(result)
+
+        if self.cache_ttl and result[0] == 200:
+            for k, (expires, _) in list(self.cache.items()):
+                if expires <= now:
+                    del self.cache[k]
+
+            self.cache[key] = (time.time() + self.cache_ttl, result, )
+
+        return result
+
+    def stats(self):
+        return {
+            'upstreams': len(self.limits),
+            'idle_connections': sum(len(x) for x in self.idle.values()),
+            'requests': self.requests,
+            'fetches': self.fetches,
+            'long_polls': self.long_polls,
+            'shared': self.shared,
+            'cache_hits': self.cache_hits,
+            'connections': self.connections,
+            'errors': self.errors,
+        }
+
+class ResultCache(object):
+    """
+        Results of the (slow, ssh based) control room queries.
+
+        A call is keyed by the action name and its arguments,
+        concurrent identical calls share a single execution,
+        the result is kept for the ttl of the action.
+        Actions changing the state on a host invalidate the keys of that host
+        (see invalidate(), keys are prefix matched).
+        Results rejected by the `ok` predicate (failures) are not kept.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+
+        self.inflight = {} # key -> AsyncResult
+        self.cache = {} # key -> (expires, result)
+
+        # results of calls started before an invalidation are not kept
+        self.generation = 0
+
+        self.calls = 0
+        self.executions = 0
+        self.shared = 0
+        self.hits = 0
+        self.invalidations = 0
+        self.failures = 0
+
+    def call(self, key, ttl, f, *args, ok=None):
+        self.calls += 1
+        now = time.time()
+
+        cached = self.cache.get(key, None)
+        if cached is not None and cached[0] > now:
+            self.hits += 1
+            return cached[1]
+
+        pending = self.inflight.get(key, None)
+        if pending is not None:
+            self.shared += 1
+            return pending.get()
+
+        generation = self.generation
+        pending = self.inflight[key] = gevent.event.AsyncResult()
+        try:
+            self.executions += 1
+            result = f(*args)
+        except BaseException as e:
+            # a killed call must not leave the waiters blocked
+            pending.set_exception(e)
+            raise
+        finally:
+            del self.inflight[key]
+
+        pending.set(result)
+
+        if ok is not None and not ok(result):
+            self.failures += 1
+        elif self.enabled and ttl and generation == self.generation:
+            for k, (expires, _) in list(self.cache.items()):
+                if expires <= now:
+                    del self.cache[k]
+
+            self.cache[key] = (time.time() + ttl, result, )
+
+        return result
+
+    def invalidate(self, *prefix):
+        self.generation += 1
+        for k in list(self.cache.keys()):
+            if k[:len(prefix)] == prefix:
+                self.invalidations += 1
+                del self.cache[k]
+
+    def stats(self):
+        return {
+            'entries': len(self.cache),
+            'calls': self.calls,
+            'executions': self.executions,
+            'shared': self.shared,
+            'hits': self.hits,
+            'invalidations': self.invalidations,
+            'failures': self.failures,
+        }
+
+class UpstreamSocket(WebSocketClient):
+    """
+        /sync subscription to another node, messages are passed to the UpstreamSubscription.
+    """
+
+    def __init__(self, url, subscription, timeout=10):
+        WebSocketClient.__init__(self, url)
+
+        # the client creates a blocking socket (we don't monkey patch)
+        sock = self.sock
+        self.sock = gevent.socket.socket(sock.family, sock.type, sock.proto)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # the kernel defaults take two hours to notice a dead upstream
+        for opt, value in (("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 10), ("TCP_KEEPCNT", 3), ):
+            if hasattr(socket, opt):
+                self.sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), value)
+        self.sock.settimeout(timeout)
+        sock.close()
+
+        self.subscription = subscription
+        self.finished = gevent.event.Event()
+
+    def handshake_ok(self):
+        # idle subscriptions are fine, keep-alive detects the dead ones
+        self.sock.settimeout(None)
+        WebSocketClient.handshake_ok(self)
+
+    def received_message(self, message):
+        self.subscription.handle(message)
+
+    def closed(self, code, reason=None):
+        self.finished.set()
+
+class UpstreamSubscription(object):
+    """
+        Keeps a /sync subscription to a single node (aggregator mode)
+        and reconnects from the last rev it received.
+    """
+
+    def __init__(self, db, source, horizon=0, retry_delay=5):
+        self.db = db
+        self.source = source
+        self.horizon = horizon
+        self.retry_delay = retry_delay
+
+        self.url = "ws://%s/sync" % source
+        self.last_rev = None
+        self.connected = False
+        self.connects = 0
+        self.received = 0
+
+    def handle(self, message):
+        jsn = json.loads(message.data)
+        if jsn["event"] != "update_headers":
+            return
+
+        headers = jsn.get("headers", [])
+        if headers:
+            self.received += len(headers)
+            self.db.merge(self.source, headers)
+
+        if jsn["rev"][1] is not None and (self.last_rev is None or jsn["rev"][1] > self.last_rev):
+            self.last_rev = jsn["rev"][1]
+
+    def run_greenlet(self):
+        while True:
+            try:
+                ws = UpstreamSocket(self.url, self)
+                ws.connect()
+
+                self.connects += 1
+                self.connected = True
+                log.info("Aggregator: subscribed to %s (from rev %s)", self.source, self.last_rev)
+
+                ws.send(json.dumps({
+                    'event': 'sync_request',
+                    'known_rev': self.last_rev,
+                    'horizon': self.horizon,
+                }))
+
+                ws.finished.wait()
+            except gevent.GreenletExit:
+                raise
+            except (socket.error, HandshakeError) as e:
+                log.warning("Aggregator: subscription to %s failed: %s", self.source, e)
+            except:
+                log.warning("Aggregator: subscription to %s failed.", self.source, exc_info=True)
+
+            self.connected = False
+            gevent.sleep(self.retry_delay)
+
+    def stats(self):
+        return {
+            'connected': self.connected,
+            'last_rev': self.last_rev,
+            'connects': self.connects,
+            'received': self.received,
+        }
+
+class AggregatedDatabase(Database):
+    """
+        Merged view of other nodes, for the aggregator mode.
+
+        Every source is followed by a single /sync subscription (UpstreamSubscription),
+        its headers are kept in the index as "<source>/<id>" with revs assigned here,
+        the revs received from each source form the rev vector.
+        Documents are fetched from their source when a client asks for them
+        (and kept in the document cache).
+
+        Deletions are not sent to the subscribers, every reconcile_interval seconds
+        the ids are compared with a full snapshot of each source (see reconcile).
+    """
+
+    def __init__(self, sources, cache=None, horizon=0, upstreams=None, reconcile_interval=600):
+        Database.__init__(self, db=None, cache=cache)
+        self.reconcile_interval = reconcile_interval
+
+        self.upstreams = upstreams or UpstreamPool(cache_ttl=0)
+        self.subscriptions = collections.OrderedDict()
+        for source in sources:
+            self.subscriptions[source] = UpstreamSubscription(self, source, horizon=horizon)
+
+        # upstream rev of every merged header, to skip the ones we already have
+        self.upstream_revs = {}
+        self.dropped = 0
+
+        # local revs follow the current time (in us), they only run ahead of it
+        # above a million merged headers per second,
+        # so they keep increasing if the aggregator is restarted
+        self.next_rev = 0
+
+    def allocate_rev(self):
+        self.next_rev = max(self.next_rev + 1, int(time.time() * 1000000))
+        return self.next_rev
+
+    def run_greenlets(self):
+        greenlets = [gevent.spawn(sub.run_greenlet) for sub in self.subscriptions.values()]
+        if self.reconcile_interval:
+            greenlets.append(gevent.spawn(self.run_reconcile_greenlet))
+
+        return greenlets
+
+    def run_reconcile_greenlet(self):
+        while True:
+            gevent.sleep(self.reconcile_interval)
+
+            for source, sub in self.subscriptions.items():
+                if not sub.connected:
+                    continue
+
+                try:
+                    dropped = self.reconcile(source)
+                    if dropped:
+                        log.info("Aggregator: dropped %d documents deleted on %s", dropped, source)
+                except (socket.error, http.client.HTTPException, ValueError) as e:
+                    log.warning("Aggregator: reconciling %s failed: %s", source, e)
+
+    def reconcile(self, source):
+        """
+            Drops the ids the source no longer has.
+            Headers merged after the snapshot was taken are kept.
+        """
+        host, port = source.rsplit(":", 1)
+        msg = json.dumps({ 'event': 'sync_request', 'known_rev': None, 'horizon': 0, 'format': 'columns' })
+        body = json.dumps({ 'messages': [msg] }).encode("utf-8")
+
+        status, _, content = self.upstreams.post(host, port, "/sync_proxy", body, timeout=60)
+        if status != 200:
+            log.warning("Aggregator: snapshot of %s failed (status %s).", source, status)
+            return 0
+
+        present = set()
+        snapshot_rev = None
+        for msg in json.loads(content)["messages"]:
+            msg = json.loads(msg)
+            if msg.get("event") != "update_headers" or msg["rev"][1] is None:
+                continue
+
+            snapshot_rev = max(snapshot_rev or 0, msg["rev"][1])
+            if msg.get("format") == "columns":
+                present.update(msg["columns"]["_id"])
+            else:
+                present.update(h["_id"] for h in msg["headers"])
+
+        if snapshot_rev is None:
+            return 0
+
+        prefix = source + "/"
+        dropped = [id for id, rev in self.upstream_revs.items()
+            if rev <= snapshot_rev and id.startswith(prefix) and id[len(prefix):] not in present]
+
+        self.drop_ids(dropped)
+        self.dropped += len(dropped)
+        return len(dropped)
+
+    def drop_ids(self, ids):
+        # there is no local store, the ids are only dropped from the view
+        # (and merged again if the source updates them)
+        for id in ids:
+            self.upstream_revs.pop(id, None)
+            self.index.remove(id)
+
+            if self.cache is not None:
+                self.cache.invalidate(id)
+
+    def rev_vector(self):
+        return dict((source, sub.last_rev) for source, sub in self.subscriptions.items())
+
+    def merge(self, source, headers):
+        merged = []
+        for header in headers:
+            id = "%s/%s" % (source, header["_id"])
+            if self.upstream_revs.get(id, None) == header["_rev"]:
+                continue
+
+            self.upstream_revs[id] = header["_rev"]
+
+            header = dict(header)
+            header["_id"] = id
+            header["_rev"] = self.allocate_rev()
+            merged.append(header)
+
+        if merged:
+            self.index.update(merged)
+            self.update_headers(merged)
+
+    def _fetch(self, source, ids):
+        host, port = source.rsplit(":", 1)
+        msg = json.dumps({ 'event': 'request_documents', 'ids': [id.split("/", 1)[1] for id in ids] })
+        body = json.dumps({ 'messages': [msg] }).encode("utf-8")
+
+        status, _, content = self.upstreams.post(host, port, "/sync_proxy", body, timeout=15)
+        if status != 200:
+            log.warning("Aggregator: fetching documents from %s failed (status %s).", source, status)
+            return []
+
+        bodies = []
+        for msg in json.loads(content)["messages"]:
+            msg = json.loads(msg)
+            if msg.get("event") != "update_documents":
+                continue
+
+            for doc in msg["documents"]:
+                id = "%s/%s" % (source, doc["_id"])
+                header = self.index.get(id)
+                if header is None:
+                    continue
+
+                # the document follows our ids and revs
+                doc["_id"] = id
+                doc["_rev"] = header["_rev"]
+                body = json.dumps(doc).encode("utf-8")
+
+                if self.cache is not None:
+                    self.cache.put(id, header["_rev"], body)
+
+                bodies.append(body)
+
+        return bodies
+
+    def get_document_bodies(self, ids, encoding="json"):
+        # the sources send json, it is passed as plain documents with encoding="deflate"
+        bodies = []
+        missing = collections.OrderedDict()
+        for id in set(ids):
+            header = self.index.get(id)
+            if header is None:
+                continue
+
+            body = None
+            if self.cache is not None:
+                body = self.cache.get(id, header["_rev"])
+
+            if body is None:
+                missing.setdefault(id.split("/", 1)[0], []).append(id)
+            else:
+                bodies.append(body)
+
+        jobs = [gevent.spawn(self._fetch, source, lst) for source, lst in missing.items()]
+        for job in gevent.joinall(jobs):
+            if job.successful():
+                bodies += job.value
+            else:
+                log.warning("Aggregator: fetching documents failed: %s", job.exception)
+
+        if encoding == "deflate":
+            return [(False, body, ) for body in bodies]
+
+        return bodies
+
+    def get_documents(self, ids, decode=True):
+        if decode == "deflate":
+            return self.get_document_bodies(ids, encoding="deflate")
+
+        bodies = self.get_document_bodies(ids)
+        if decode == "json" or not decode:
+            return bodies
+
+        return [json.loads(body) for body in bodies]
+
+    def stats(self):
+        return {
+            'sources': dict((source, sub.stats()) for source, sub in self.subscriptions.items()),
+            'rev_vector': self.rev_vector(),
+            'dropped': self.dropped,
+            'upstreams': self.upstreams.stats(),
+        }
+
 class WebServer(bottle.Bottle):
-    def __init__(self, db=None, opts={}):
+    def __init__(self, db=None, opts={}, ingest=None, retention=None, upstreams=None):
         bottle.Bottle.__init__(self)
 
         self.db = db
+        self.ingest = ingest
+        self.retention = retention
+        self.upstreams = upstreams or UpstreamPool()
         self.opts = opts
         self.secret = opts["web.secret"]
         self.secret_name = opts["web.secret_name"]
+
+        self.max_poll_wait = opts.get("web.poll_wait", 30)
+        self.polls = { "parked": 0, "timeouts": 0 }
+
+        self.cr_cache = ResultCache(enabled = opts.get("web.cr_cache", True))
+
         self.setup_routes()
 
     def setup_routes(self):
@@ -441,18 +3038,28 @@ class WebServer(bottle.Bottle):
         @app.get("/info")
         @check_auth
         def info():
-            c = self.db.conn.cursor()
-            c.execute("PRAGMA page_size")
-            ps = c.fetchone()[0]
-            c.execute("PRAGMA page_count")
-            pc = c.fetchone()[0]
-            c.close()
-
             return {
                 'hostname': fff_cluster.get_host(),
                 'timestamp': time.time(),
                 'cluster': fff_cluster.get_node(),
-                'db_size': ps*pc,
+                'db_size': self.db.db_size(),
+                'db_wal': self.db.wal,
+                'db_executor': self.db.executor.stats(),
+                'header_index': self.db.index.stats(),
+                'broadcast': self.db.broadcast.stats(),
+                'listeners': len(self.db.listeners),
+                'long_poll': dict(self.polls, waiting=self.db.rev_waiters),
+                'upstreams': self.upstreams.stats(),
+                'aggregator': self.db.stats() if isinstance(self.db, AggregatedDatabase) else None,
+                'ssh': fff_cluster.transport.stats(),
+                'cr_cache': self.cr_cache.stats(),
+                'clients': [c.stats() for c in self.db.listeners if hasattr(c, "stats")],
+                'ingest': self.ingest.stats() if self.ingest else None,
+                'dedup': self.db.dedup.stats() if self.db.dedup else None,
+                'zdict': self.db.zdicts.stats(),
+                'cache': self.db.cache.stats() if self.db.cache else None,
+                'deltas': self.db.deltas.stats() if self.db.deltas else None,
+                'retention': self.retention.stats() if self.retention else None,
             }
 
         @app.post("/_upload/")
@@ -461,10 +3068,26 @@ class WebServer(bottle.Bottle):
             if "cmsweb" in bottle.request.url : return
             from bottle import request
 
+            # the aggregator only mirrors other nodes, local revs would break its ordering
+            if isinstance(self.db, AggregatedDatabase):
+                raise bottle.HTTPResponse("Uploads are not accepted in aggregator mode.", status=403)
+
             j = json.loads(request.body.read())
             documents = j["docs"]
 
-            self.db.direct_transactional_upload(documents)
+            if self.ingest is not None:
+                result = self.ingest.submit(documents)
+                if result is None:
+                    raise bottle.HTTPResponse("Upload queue is full, try again later.", status=503)
+
+                # only answer once the documents are stored
+                try:
+                    result.get()
+                except Exception as e:
+                    raise bottle.HTTPResponse("Failed to store the documents: %s" % e, status=500)
+            else:
+                self.db.direct_transactional_upload(documents)
+
             log.info("Accepted %d document(s) from input connection: %s", len(documents), request.remote_addr)
 
         ### @app.route("/get/<id>", method=['GET', 'POST'])
@@ -510,15 +3133,10 @@ class WebServer(bottle.Bottle):
             data = json.loads(request.body.read())
 
             # check if id known to us
-            c = self.db.conn.cursor()
-            c.execute("SELECT body FROM Documents WHERE id = ?", (id, ))
-            doc = list(self.db.prepare_docs(c))
-            c.close()
-
-            if not doc:
+            b = self.db.get_document(id)
+            if b is None:
                 raise bottle.HTTPResponse("Process not found.", status=404)
 
-            b = doc[0]
             pid = int(b["pid"])
 
             if pid != int(data["pid"]):
@@ -546,12 +3164,7 @@ class WebServer(bottle.Bottle):
             data = json.loads(request.body.read())
             ids = data["ids"]
 
-            with self.db.conn as db:
-                for id in ids:
-                    db.execute("DELETE FROM Headers WHERE id= ?", (id, ))
-                    db.execute("DELETE FROM Documents WHERE id= ?", (id, ))
-
-            self.db.get_headers(reload=True)
+            self.db.drop_ids(ids)
             return "Deleted %s rows!" % len(ids)
 
         def verify_logfile(fn):
@@ -599,12 +3212,9 @@ class WebServer(bottle.Bottle):
         def show_log(id):
             from bottle import response
 
-            c = self.db.conn.cursor()
-            c.execute("SELECT body FROM Documents WHERE id = ?", (id, ))
-            doc = list(self.db.prepare_docs(c))
-            c.close()
-
-            b = doc[0]
+            b = self.db.get_document(id)
+            if b is None:
+                raise bottle.HTTPResponse("Document not found.", status=404)
 
             startup_fn = b.get("stdout_fn", None)
             startup_iter = []
@@ -661,6 +3271,13 @@ class WebServer(bottle.Bottle):
             data = json.loads(request.body.read())
             lst = data.get("messages", [])
 
+            # long-poll, if the client asks for it
+            wait = min(float(data.get("wait", 0) or 0), self.max_poll_wait)
+            if wait > 0:
+                self.polls["parked"] += 1
+                if not SyncSocket.proxy_wait(lst, wait):
+                    self.polls["timeouts"] += 1
+
             output = SyncSocket.proxy_mode(lst, peer_address=request.remote_addr)
             log.info( str(request.remote_addr) )
 
@@ -675,11 +3292,40 @@ class WebServer(bottle.Bottle):
         @enable_cors
         def redirect():
             from bottle import request, response
-            url = 'http://' + request.query.path + ':' + request.query.port  + '/sync_proxy'
-            r = requests.post(url, data=request.body, headers = request.headers, timeout=5)
-            return r.content
+
+            # long-polls are held upstream, the timeout has to cover them
+            body = request.body.read()
+            try:
+                wait = min(float(json.loads(body).get("wait", 0) or 0), self.max_poll_wait)
+            except (ValueError, AttributeError):
+                wait = 0
+
+            try:
+                status, content_type, content = self.upstreams.post(request.query.path, request.query.port, "/sync_proxy", body,
+                    content_type = request.content_type or "application/json", timeout = 5 + wait, long_poll = wait > 0)
+            except (socket.error, http.client.HTTPException) as e:
+                raise bottle.HTTPResponse("Upstream request failed: %s" % e, status=502)
+
+            response.status = status
+            response.content_type = content_type
+            return content
 
         ### API for DQM^2 Control Room
+        # seconds the answers to the read-only actions are reused
+        cr_ttl = {
+            "get_cmssw_info": 300,
+            "get_dqm_clients": 60,
+            "get_hltd_versions": 300,
+            "get_fff_versions": 300,
+            "get_simulator_config": 30,
+            "get_simulator_runs": 60,
+        }
+
+        def cached(what, f, *args):
+            # ssh errors and timeouts are returned as fff_cluster.Failure
+            return app.cr_cache.call((what, ) + args, cr_ttl[what], f, *args,
+                ok = lambda answer: not fff_cluster.failed(answer))
+
         @app.route("/cr/exe")
         @check_auth
         def cr_api():
@@ -694,7 +3340,7 @@ class WebServer(bottle.Bottle):
               cmssw_path  = self.opts["cmssw_path_playback"] if playback == "1" else self.opts["cmssw_path_production"]
               cmssw_path += self.opts["dqm_clients_subdir"]
               clients_path = self.opts["hltd_clients_path"]
-              answer = fff_cluster.get_dqm_clients( host, cmssw_path, clients_path )
+              answer = cached("get_dqm_clients", fff_cluster.get_dqm_clients, host, cmssw_path, clients_path)
               return json.dumps( answer )
 
             if what == "change_dqm_client" : 
@@ -706,11 +3352,13 @@ class WebServer(bottle.Bottle):
               client = bottle.request.query.get('client', default=None)
               state  = bottle.request.query.get('state', default=0)
               answer = fff_cluster.change_dqm_client( host, cmssw_path, clients_path, client, state )
+              app.cr_cache.invalidate("get_dqm_clients", host)
               return answer
 
             if what == "get_cmssw_info" : 
-              answer_1 = fff_cluster.get_cmssw_info( self.opts["cmssw_path_playback"] )
-              answer_2 = fff_cluster.get_cmssw_info( self.opts["cmssw_path_production"] )
+              jobs = [ gevent.spawn(cached, "get_cmssw_info", fff_cluster.get_cmssw_info, self.opts["cmssw_path_playback"]),
+                       gevent.spawn(cached, "get_cmssw_info", fff_cluster.get_cmssw_info, self.opts["cmssw_path_production"]) ]
+              answer_1, answer_2 = [ job.get() for job in jobs ]
               answer = "\n<strong>Playback:</strong>\n" + answer_1 + "\n<strong>Production:</strong>\n" + answer_2
               return answer
 
@@ -725,43 +3373,46 @@ class WebServer(bottle.Bottle):
                 return json.dumps( nodes )
 
             if what == "get_hltd_versions" : 
-              answer = fff_cluster.get_rpm_version_all("/opt/hltd")
+              answer = cached("get_hltd_versions", fff_cluster.get_rpm_version_all, "/opt/hltd")
               return json.dumps( answer )
 
             if what == "get_fff_versions" : 
-              answer = fff_cluster.get_rpm_version_all("/opt/fff_dqmtools")
+              answer = cached("get_fff_versions", fff_cluster.get_rpm_version_all, "/opt/fff_dqmtools")
               return json.dumps( answer )
 
             if what == "get_simulator_config" :
               host = bottle.request.query.get('host', default="dqmrubu-c2a06-03-01")
-              answer = fff_cluster.get_simulator_config( self.opts, fff_cluster.get_host(), host )
+              answer = cached("get_simulator_config", lambda host: fff_cluster.get_simulator_config( self.opts, fff_cluster.get_host(), host ), host)
               return json.dumps( answer )
 
             if what == "get_simulator_runs" :
               host = bottle.request.query.get('host', default="dqmrubu-c2a06-03-01")
-              answer = fff_cluster.get_simulator_runs( self.opts, fff_cluster.get_host(), host )
+              answer = cached("get_simulator_runs", lambda host: fff_cluster.get_simulator_runs( self.opts, fff_cluster.get_host(), host ), host)
               return json.dumps( answer )
 
             if what == "restart_hltd":
               host = bottle.request.query.get('host', default=None)
               answer = "Specify host to restart HLTD"
-              if host : answer = fff_cluster.restart_hltd( host )
+              if host :
+                answer = fff_cluster.restart_hltd( host )
+                app.cr_cache.invalidate("get_hltd_versions")
               return answer
 
             if what == "restart_fff":
               host = bottle.request.query.get('host', default=None)
               answer = "Specify host to restart FFF"
-              if host : answer = fff_cluster.restart_fff( host )
+              if host :
+                answer = fff_cluster.restart_fff( host )
+                app.cr_cache.invalidate("get_fff_versions")
               return answer
 
             if what == "get_hltd_logs":
               host = bottle.request.query.get('host', default=None)
               answer = ["Specify host HLTD", "Specify host HLTD"]
               if host : 
-                answer_hltd = fff_cluster.get_txt_file( host, self.opts["hltd_logfile"], 30 )
-                answer_anelastic = fff_cluster.get_txt_file( host, self.opts["anelastic_logfile"], 30 )
-                
-                answer = [answer_hltd, answer_anelastic]
+                jobs = [ gevent.spawn(fff_cluster.get_txt_file, host, self.opts["hltd_logfile"], 30),
+                         gevent.spawn(fff_cluster.get_txt_file, host, self.opts["anelastic_logfile"], 30) ]
+                answer = [ job.get() for job in jobs ]
               return json.dumps(answer)
 
             if what == "get_fff_logs":
@@ -774,7 +3425,12 @@ class WebServer(bottle.Bottle):
               host = bottle.request.query.get('host', default="dqmrubu-c2a06-03-01")
               if( fff_cluster.get_host() != host ) :
                 url = 'http://' + host + ':' + str(self.opts["web.port"])  + '/cr/exe?' + bottle.request.urlparts.query
-                r = requests.get(url, data=bottle.request.body, headers = bottle.request.headers, timeout=60)
+                try:
+                  r = requests.get(url, data=bottle.request.body, headers = bottle.request.headers, timeout=60)
+                finally:
+                  # only once the config is written, queries started before are not kept
+                  app.cr_cache.invalidate("get_simulator_config", host)
+                  app.cr_cache.invalidate("get_simulator_runs", host)
                 return r.content
 
               run_number   = bottle.request.query.get("run_number", default=None)
@@ -789,6 +3445,8 @@ class WebServer(bottle.Bottle):
               cfg = fff_cluster.update_config(cfg, "run_key", run_class)
               cfg = fff_cluster.update_config(cfg, "number_of_ls", int(number_of_ls))
               fff_cluster.write_config( self.opts, cfg )
+              app.cr_cache.invalidate("get_simulator_config", host)
+              app.cr_cache.invalidate("get_simulator_runs", host)
 
               # start new run
               sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
@@ -813,12 +3471,50 @@ def run_web_greenlet(db, host="0.0.0.0", port=9215, opts = {}, **kwargs):
 
     from ws4py.server.geventserver import WSGIServer, WebSocketWSGIHandler
     from ws4py.server.wsgiutils import WebSocketWSGIApplication
+    from ws4py.compression import PerMessageDeflate
     from ws4py.websocket import EchoWebSocket
 
     SyncSocket.db = db
-
-    static_app = WebServer(db, opts)
-    static_app.mount('/sync', WebSocketWSGIApplication(handler_cls = SyncSocket))
+    SyncSocket.sync_horizon = opts.get("web.sync_horizon", 48*3600)
+
+    # the aggregator does not accept uploads
+    ingest = None
+    if not isinstance(db, AggregatedDatabase):
+        ingest = IngestQueue(db,
+            max_delay = opts.get("web.ingest_delay", 0.05),
+            max_size = opts.get("web.ingest_size", 1000),
+            max_pending = opts.get("web.ingest_max_pending", 10000))
+        gevent.spawn(ingest.run_greenlet)
+
+    if db.zdicts.enabled:
+        gevent.spawn(db.run_dictionary_greenlet)
+
+    if isinstance(db, AggregatedDatabase):
+        db.run_greenlets()
+
+    retention = None
+    if opts.get("web.retention_ttl") or opts.get("web.retention_host_cap"):
+        retention = RetentionEngine(db,
+            ttl = opts.get("web.retention_ttl"),
+            host_cap = opts.get("web.retention_host_cap"))
+        gevent.spawn(retention.run_greenlet)
+
+    upstreams = UpstreamPool(
+        max_per_upstream = opts.get("web.redirect_concurrency", 8),
+        cache_ttl = opts.get("web.redirect_cache_ttl", 1.0))
+
+    static_app = WebServer(db, opts, ingest=ingest, retention=retention, upstreams=upstreams)
+    extensions = []
+    if opts.get("web.ws_deflate", True):
+        # binary frames carry zlib streams already (see SyncSocket.makeDeflateFrame)
+        takeover = opts.get("web.ws_deflate_context_takeover", True)
+        extensions.append(PerMessageDeflate(
+            server_no_context_takeover = not takeover,
+            server_max_window_bits = opts.get("web.ws_deflate_window_bits", 15),
+            max_memory = opts.get("web.ws_deflate_memory", 256) * 1024,
+            compress_binary = False))
+
+    static_app.mount('/sync', WebSocketWSGIApplication(handler_cls = SyncSocket, extensions = extensions))
 
     server = WSGIServer(listener, static_app)
 
@@ -839,7 +3535,45 @@ def __run__(opts, **kwargs):
     db_string = opts["web.db"]
     port      = opts["web.port"]
 
-    db = Database(db = db_string)
+    dedup = None
+    if opts.get("web.dedup", False):
+        dedup = UploadDeduplicator(
+            volatile = opts.get("web.dedup_volatile", {}),
+            max_age = opts.get("web.dedup_max_age", 60))
+
+    zdicts = DictionaryStore(enabled = opts.get("web.db_zdict", False))
+
+    cache = None
+    if opts.get("web.cache_size", 64) > 0:
+        cache = DocumentCache(max_bytes = opts.get("web.cache_size", 64)*1024*1024)
+
+    deltas = None
+    if opts.get("web.push_deltas", True):
+        deltas = DocumentDeltas()
+
+    aggregate = opts.get("web.aggregate", None)
+    if aggregate:
+        # serve the merged view of other nodes (instead of a local store)
+        if aggregate is True:
+            aggregate = [host for hosts in fff_cluster.clusters.values() for host in hosts]
+
+        sources = [x if ":" in x else "%s:%d" % (x, 9215) for x in aggregate]
+        db = AggregatedDatabase(sources,
+            cache = cache,
+            reconcile_interval = opts.get("web.aggregate_reconcile", 600))
+
+        fwt = gevent.spawn(run_web_greenlet, db, port = port, opts = opts)
+        gevent.joinall([fwt], raise_error=True)
+        return
+
+    db = Database(db = db_string,
+        wal = opts.get("web.db_wal", False),
+        readers = opts.get("web.db_readers", 2),
+        threads = opts.get("web.db_threads", 4),
+        dedup = dedup,
+        zdicts = zdicts,
+        cache = cache,
+        deltas = deltas)
 
     fwt = gevent.spawn(run_web_greenlet, db, port = port, opts = opts)
     gevent.joinall([fwt], raise_error=True)
@@ -3,10 +3,20 @@
 # this should later become a reader for a configuration file in /etc/
 
 import socket
-import subprocess
 import os
-from threading import Timer
+import stat
+import signal
 import json
+import time
+import shlex
+
+# cooperative, the web server keeps running while we wait for ssh
+import gevent
+import gevent.pool
+import gevent.lock
+from gevent import subprocess
+
+from utils.release_inspector import ReleaseInspector
 
 clusters = {
   'production_c2a06': ["dqmrubu-c2a06-01-01.cms", "dqmfu-c2b03-45-01.cms", "dqmfu-c2b04-45-01.cms"],
@@ -14,65 +24,317 @@ clusters = {
   'lookarea_c2a06': ["dqmrubu-c2a06-05-01.cms"]
 }
 
+# max number of hosts contacted at the same time
+max_parallel = 16
 
+def kill_group(p):
+  try:
+    os.killpg(p.pid, signal.SIGKILL)
+  except OSError:
+    pass
+
+class Failure(str):
+  """ Error message returned instead of the output of a command,
+    it is still a string for the callers, but it is not cached (see failed()).
+  """
+
+def failed(answer):
+  """ True if the answer is (or contains) a Failure. """
+  if isinstance(answer, Failure): return True
+  if isinstance(answer, dict): return any(failed(x) for x in answer.values())
+  if isinstance(answer, (list, tuple)): return any(failed(x) for x in answer)
+  return False
 
 def popen_timeout(cmd, seconds=10):
-  kill = lambda process: process.kill()
-  p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-  timer = Timer(seconds, kill, [p])
-  answer, stderr = " ... ",  " ... " 
   try:
-    timer.start()
-    answer, stderr = p.communicate()
+    # own process group, so the children of the shell are killed with it
+    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
   except Exception as error_log:
-    answer = error_log
-  if p.returncode : answer = stderr
-  timer.cancel()
-  return answer
+    return Failure(error_log)
+
+  try:
+    answer, stderr = p.communicate(timeout=seconds)
+  except subprocess.TimeoutExpired:
+    kill_group(p)
+    answer, stderr = p.communicate()
+    stderr = stderr or ("timeout after %s seconds" % seconds).encode("utf-8")
+  except BaseException as error_log:
+    kill_group(p)
+    p.wait()
+    if not isinstance(error_log, Exception): raise
+    return Failure(error_log)
+
+  if p.returncode : return Failure(stderr.decode("utf-8", "replace"))
+  return answer.decode("utf-8", "replace")
+
+def run_parallel(f, args_list, concurrency=None):
+  """ Calls f(*args) for every args in args_list,
+    at most `concurrency` (max_parallel) at the same time.
+    Yields (args, result) as soon as each call finishes.
+  """
+  pool = gevent.pool.Pool(concurrency or max_parallel)
+
+  def call(args):
+    return args, f(*args)
+
+  try:
+    for x in pool.imap_unordered(call, args_list):
+      yield x
+  finally:
+    pool.kill()
+
+def run_on_hosts(f, hosts, *args, **kwargs):
+  """ Yields (host, f(host, *args)) for every host,
+    in the order they answer.
+  """
+  args_list = [ (host, ) + args for host in hosts ]
+  for a, result in run_parallel(f, args_list, kwargs.get("concurrency")):
+    yield a[0], result
+
+class SSHPool(object):
+  """ Runs commands on the other hosts through one ssh master
+    connection per host (ControlMaster), so a command only opens
+    a channel instead of doing a full ssh handshake.
+
+    Masters are started on first use, checked (ssh -O check) if they
+    were not used for `check_interval` seconds and closed after
+    `max_idle` seconds without commands (ssh also exits them by itself,
+    via ControlPersist). If a master can't be started, commands fall
+    back to plain ssh connections.
+
+    The control sockets carry our commands (sudo included), they are
+    only used if the directory is ours and private (see control_dir_ok),
+    otherwise every command is a plain ssh connection.
+  """
+
+  def __init__(self, control_dir=None, max_idle=300, check_interval=30, connect_timeout=5):
+    if control_dir is None:
+      runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+      if runtime_dir:
+        control_dir = os.path.join(runtime_dir, "fff_dqmtools_ssh")
+      else:
+        control_dir = "/tmp/fff_dqmtools_ssh.%d" % os.getuid()
+
+    self.control_dir = control_dir
+    self.max_idle = max_idle
+    self.check_interval = check_interval
+    self.connect_timeout = connect_timeout
+
+    # host -> {"started", "last_used", "last_check"}
+    self.masters = {}
+    self.locks = {}
+
+    # host -> time of the last failed start, not retried for check_interval
+    self.failed = {}
+
+    self.counters = { "commands": 0, "started": 0, "failed": 0, "checks": 0, "restarted": 0, "expired": 0, "insecure": 0 }
+
+  def control_dir_ok(self):
+    # the directory is created if it is missing, an existing one must be
+    # a real directory (not a symlink), owned by us and not accessible by others
+    try:
+      os.mkdir(self.control_dir, 0o700)
+    except FileExistsError:
+      pass
+    except OSError:
+      return False
+
+    try:
+      st = os.lstat(self.control_dir)
+    except OSError:
+      return False
+
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and (st.st_mode & 0o077) == 0
+
+  def ssh_args(self, host, control=True):
+    args = ["ssh",
+      "-o", "BatchMode=yes",
+      "-o", "ConnectTimeout=%d" % self.connect_timeout,
+      "-o", "ServerAliveInterval=15",
+    ]
+
+    if control:
+      args += ["-o", "ControlPath=%s/%%C" % self.control_dir]
+    else:
+      args += ["-o", "ControlPath=none"]
+
+    return args
+
+  def remaining(self, timeout, deadline):
+    if deadline is None:
+      return timeout
+
+    return min(timeout, deadline - time.time())
+
+  def control(self, host, op, deadline=None):
+    # returns True on success
+    timeout = self.remaining(self.connect_timeout, deadline)
+    if timeout <= 0:
+      return False
+
+    args = self.ssh_args(host) + ["-O", op, host]
+    try:
+      return subprocess.call(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout) == 0
+    except subprocess.TimeoutExpired:
+      return False
+
+  def start(self, host, deadline=None):
+    # -f backgrounds the master once authenticated, it must not hold our pipes
+    timeout = self.remaining(self.connect_timeout + 5, deadline)
+    args = self.ssh_args(host) + ["-M", "-N", "-f", "-o", "ControlPersist=%d" % self.max_idle, host]
+    try:
+      ok = timeout > 0 and subprocess.call(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        timeout=timeout) == 0
+    except subprocess.TimeoutExpired:
+      ok = False
+
+    if not ok:
+      self.failed[host] = time.time()
+      self.counters["failed"] += 1
+      return False
+
+    self.failed.pop(host, None)
+
+    now = time.time()
+    self.masters[host] = { "started": now, "last_used": now, "last_check": now }
+    self.counters["started"] += 1
+    return True
+
+  def stop(self, host):
+    self.masters.pop(host, None)
+    self.control(host, "exit")
+
+  def expire_idle(self):
+    now = time.time()
+    for host, master in list(self.masters.items()):
+      if now - master["last_used"] > self.max_idle:
+        self.counters["expired"] += 1
+        self.stop(host)
+
+  def ensure_master(self, host, deadline=None):
+    # one greenlet starts (or checks) the master, the others wait for it
+    # (both count against the deadline of the command)
+    lock = self.locks.setdefault(host, gevent.lock.Semaphore())
+    timeout = self.remaining(self.connect_timeout + 5, deadline)
+    if timeout <= 0 or not lock.acquire(timeout=timeout):
+      return False
+
+    try:
+      now = time.time()
+      master = self.masters.get(host)
+      if master is None:
+        if now - self.failed.get(host, 0) < self.check_interval:
+          return False
+
+        return self.start(host, deadline)
+
+      if now - master["last_check"] > self.check_interval:
+        self.counters["checks"] += 1
+        if self.control(host, "check", deadline):
+          master["last_check"] = now
+        else:
+          self.masters.pop(host, None)
+          self.counters["restarted"] += 1
+          return self.start(host, deadline)
+
+      return True
+    finally:
+      lock.release()
+
+  def command(self, host, cmd, deadline=None):
+    self.expire_idle()
+    self.counters["commands"] += 1
+
+    if not self.control_dir_ok():
+      self.counters["insecure"] += 1
+      args = self.ssh_args(host, control=False) + [host, cmd]
+      return " ".join(shlex.quote(x) for x in args)
+
+    self.ensure_master(host, deadline)
+    if host in self.masters:
+      self.masters[host]["last_used"] = time.time()
+
+    # ControlMaster=no: use the master if it is there, connect directly otherwise
+    args = self.ssh_args(host) + ["-o", "ControlMaster=no", host, cmd]
+    return " ".join(shlex.quote(x) for x in args)
+
+  def stats(self):
+    now = time.time()
+    d = dict(self.counters)
+    d["masters"] = dict((host, { "age": now - m["started"], "idle": now - m["last_used"] }) for host, m in self.masters.items())
+    return d
+
+class LocalExec(object):
+  """ Runs the "remote" commands on this machine,
+    for testing without ssh (set fff_cluster.transport).
+  """
+
+  def __init__(self):
+    self.counters = { "commands": 0 }
+
+  def command(self, host, cmd, deadline=None):
+    self.counters["commands"] += 1
+    return "sh -c " + shlex.quote(cmd)
+
+  def stats(self):
+    return dict(self.counters)
+
+# used by remote()
+transport = SSHPool()
+
+# release areas read by get_cmssw_info()
+release_inspector = ReleaseInspector()
+
+def remote(host, cmd, seconds=10):
+  """ Runs a shell command on the host, see popen_timeout().
+    Starting the ssh master counts against `seconds`.
+  """
+  deadline = time.time() + seconds
+  cmd = transport.command(host, cmd, deadline)
+
+  left = deadline - time.time()
+  if left <= 0 : return Failure("timeout after %s seconds" % seconds)
+  return popen_timeout([cmd], left)
 
 def get_rpm_version(host, soft_path):
   if not host : return "host argument not defined"
   if not soft_path : return "soft_path argument not defined"
-  return popen_timeout(["ssh " + host + " \"rpm -qf " + soft_path + "\""], 5)
+  return remote(host, "rpm -qf " + soft_path, 5)
   
-def get_rpm_version_all(soft_path):
-  answer = {}
+def iter_rpm_version_all(soft_path):
+  """ Yields (cluster, host, version) as each host answers. """
+  cluster_of = {}
   for key, lst in clusters.items():
-    subanswer = {}
     for host in lst:
-      version = get_rpm_version( host, soft_path )
-      subanswer[ host ] = version
-    answer[key] = subanswer
+      cluster_of.setdefault(host, []).append(key)
+
+  for host, version in run_on_hosts(get_rpm_version, list(cluster_of), soft_path):
+    for key in cluster_of[host]:
+      yield key, host, version
+
+def get_rpm_version_all(soft_path):
+  answer = dict((key, {}) for key in clusters)
+  for key, host, version in iter_rpm_version_all(soft_path):
+    answer[key][host] = version
 
   return answer
 
 def get_cmssw_info( cmssw_path ):
   if not cmssw_path : return "cmssw_path argument not defined"
-  if cmssw_path[-1] != '/' : cmssw_path += '/'
-  
-  # 1. read CMSSW logs
-  versions_raw = popen_timeout(["grep \"Selected release:\" --exclude-dir=\"*\" --include=*.log " + cmssw_path + "*"], 15)
-  if not "Selected release:" in versions_raw : return versions_raw
-  answer = versions_raw.split("Selected release: ")[-1]
-  
-  # 2. get PRs
-  prs_raw = popen_timeout(["find " + cmssw_path + " -type f -name \"merge*log\""], 15)
+
+  # the logs are read in a thread, not on the hub
+  info = gevent.get_hub().threadpool.apply( release_inspector.inspect, (cmssw_path, ) )
+  if info["release"] is None : return "Selected release not found in " + cmssw_path
+  answer = info["release"] + "\n"
+
   answer += "PRs :"
+  for pr in info["pull_requests"]:
+    answer += "\n " + pr["label"];
+    answer += " ok" if pr["merged"] else " "
 
-  # 3. get PRs merge status
-  for fname in prs_raw.split("\n"):
-    try:
-      pr_id = os.path.basename( fname ).split(".")[1]
-      status = popen_timeout(["grep \"Merge successful\" " + fname], 15)  
-      answer += "\n " + pr_id;  
-      answer += " ok" if status else " "
-    except: continue
-
-  # 4. get GTs
-  gts_raw = popen_timeout(["grep -r \"GlobalTag.globaltag = \" " + cmssw_path + "src/DQM/Integration/python/config/*"], 15)
-  if not "GlobalTag.globaltag" in gts_raw : return answer
+  if not info["global_tags"] : return answer
   answer += "\nGTs:\n"
-  for line in gts_raw.split("\n"):
+  for line in info["global_tags"]:
     if "autoCond" in line : continue;
     answer += line + "\n"
 
@@ -81,8 +343,11 @@ def get_cmssw_info( cmssw_path ):
 def get_dqm_clients( host, cmssw_path, clients_path ):
   if not host : return "host argument not defined"
   if not cmssw_path : return "cmssw_path argument not defined"
-  available = popen_timeout(["ssh " + host + " \"find " + cmssw_path + " -type f -name *_cfg.py\""], 15)
-  activated = popen_timeout(["ssh " + host + " \"find " + clients_path + " -type l\""], 15)
+  jobs = [ gevent.spawn(remote, host, "find " + cmssw_path + " -type f -name *_cfg.py", 15),
+           gevent.spawn(remote, host, "find " + clients_path + " -type l", 15) ]
+  available, activated = [ job.get() for job in jobs ]
+  if failed(available) : return available
+  if failed(activated) : return activated
 
   available = [ os.path.basename( a ) for a in available.split("\n") if a ]
   activated = [ os.path.basename( a ) for a in activated.split("\n") if a ]
@@ -93,10 +358,10 @@ def get_dqm_clients( host, cmssw_path, clients_path ):
 def change_dqm_client( host, cmssw_path, clients_path, client, state ):
   answer = None
   if state == "0":
-    answer = popen_timeout(["ssh " + host + " \"sudo find " + clients_path + " -type l -name " + client + " -delete\""], 15)
+    answer = remote(host, "sudo find " + clients_path + " -type l -name " + client + " -delete", 15)
   else :
     inp = os.path.join( cmssw_path, client )
-    answer = popen_timeout(["ssh " + host + " \"cd " + clients_path + "/idle; sudo ln -s " + inp + "\""], 15)
+    answer = remote(host, "cd " + clients_path + "/idle; sudo ln -s " + inp, 15)
 
   if not answer : return "Ok"
   return answer
@@ -106,7 +371,7 @@ def get_simulator_config(opts, this_host, simulator_host):
   path = opts["simulator.conf"]
   cfg = None
   if this_host == simulator_host : cfg = popen_timeout(["cat " + path], 5)
-  else                           : cfg = popen_timeout(["ssh " + simulator_host + " \"cat " + path + "\""], 5)
+  else                           : cfg = remote(simulator_host, "cat " + path, 5)
   return cfg
 
 def update_config(cfg, key, value):
@@ -131,7 +396,8 @@ def get_simulator_runs(opts, this_host, simulator_host):
   path = os.path.dirname( cfg["source"] )
   runs_raw = None
   if this_host == simulator_host : runs_raw = popen_timeout(["ls -1d " + path + "/run*"], 5)
-  else                           : runs_raw = popen_timeout(["ssh " + simulator_host + " \"ls -1d " + path + "/run*\""], 5)
+  else                           : runs_raw = remote(simulator_host, "ls -1d " + path + "/run*", 5)
+  if failed(runs_raw) : return runs_raw
   runs = []
   for run in runs_raw.split("\n"):
     runs += [ os.path.basename( run ) ]
@@ -139,20 +405,20 @@ def get_simulator_runs(opts, this_host, simulator_host):
 
 def restart_hltd(host):
   if not host : return "host argument not defined"
-  answer = popen_timeout(["ssh " + host + " \"sudo -i /sbin/service hltd stop; sudo -i /sbin/service hltd start\""], 15)
+  answer = remote(host, "sudo -i /sbin/service hltd stop; sudo -i /sbin/service hltd start", 15)
   if not answer : return "Ok"
   return answer
 
 def restart_fff(host):
   if not host : return "host argument not defined"
-  answer = popen_timeout(["ssh " + host + " \"sudo systemctl restart fff_dqmtools.service\""], 15)
+  answer = remote(host, "sudo systemctl restart fff_dqmtools.service", 15)
   if not answer : return "Ok"
   return answer
 
 def get_txt_file(host, path, timeout=30):
   if not host : return "host argument not defined"
   if not path : return "path argument not defined"
-  return popen_timeout(["ssh " + host + " \"cat " + path + "\""], timeout)
+  return remote(host, "cat " + path, timeout)
 
 def get_host():
   host = socket.gethostname()
@@ -363,6 +363,23 @@ def detach(logfile, pidfile):
         f.write("%d\n" % os.getpid())
         f.close()
 
+# command line values of the options (see key_types)
+def parse_bool(x):
+    v = x.strip().lower()
+    if v in ("1", "true", "yes", "on"):
+        return True
+    if v in ("0", "false", "no", "off", ""):
+        return False
+
+    raise ValueError("Invalid boolean value: %s" % x)
+
+def parse_hosts(x):
+    # a comma separated list of hosts, or a boolean
+    try:
+        return parse_bool(x) or None
+    except ValueError:
+        return x.split(",")
+
 # this is no longer used
 # this process only acts as a supervisor, if it crashes - let it crash
 ##def run_supervised(f):
@@ -422,6 +439,41 @@ if __name__ == "__main__":
         "anelastic_logfile": "/var/log/hltd/anelastic.log",
 
         "web.db": "/var/lib/fff_dqmtools/db.20171027.sqlite3",
+        "web.db_wal": False,
+        "web.db_readers": 2,
+        "web.db_threads": 4,
+        "web.db_zdict": False,
+        "web.cache_size": 64, # MiB
+        "web.push_deltas": True,
+        "web.sync_horizon": 48*3600, # seconds, 0 sends everything on the initial sync
+        "web.poll_wait": 30, # max seconds a /sync_proxy long-poll is held
+        "web.redirect_concurrency": 8, # requests per node through /redirect
+        "web.redirect_cache_ttl": 1.0, # seconds identical /redirect responses are shared
+        "web.cr_cache": True, # reuse the answers to read-only control room queries (/cr/exe)
+        # aggregator mode: follow these nodes ("host" or "host:port", true for the whole cluster)
+        # and serve their merged view instead of a local store
+        "web.aggregate": None,
+        "web.aggregate_reconcile": 600, # seconds between the checks for deleted documents, 0 disables them
+        "web.ingest_delay": 0.05,
+        "web.ingest_size": 1000,
+        "web.ingest_max_pending": 10000, # documents queued before uploads are held back (503)
+        # skip the uploads which did not change the document (off by default):
+        # the stored document, and its timestamp, stay the ones of the last write,
+        # up to dedup_max_age seconds old, so it only pays off for producers
+        # uploading more often than that (keep it below the "stale" warning, 300s)
+        "web.dedup": False,
+        "web.dedup_max_age": 60,
+        # per document type, fields which do not make a document "changed"
+        "web.dedup_volatile": {},
+        # max age (seconds) per document type, and max documents per (hostname, type)
+        # ie, {"dqm-source-state": 15552000}, nothing is deleted by default
+        "web.retention_ttl": {},
+        "web.retention_host_cap": {},
+        # permessage-deflate on /sync, memory is the compressor limit per connection (KiB)
+        "web.ws_deflate": True,
+        "web.ws_deflate_context_takeover": True,
+        "web.ws_deflate_window_bits": 15,
+        "web.ws_deflate_memory": 256,
         "web.port": 9215,
         "web.secret": config_web_secret,
         "web.secret_name": "selenium-secret-secret",
@@ -447,12 +499,37 @@ if __name__ == "__main__":
 
         "web.port": int,
         "web.db": str,
+        "web.db_wal": parse_bool,
+        "web.db_readers": int,
+        "web.db_threads": int,
+        "web.db_zdict": parse_bool,
+        "web.cache_size": int,
+        "web.push_deltas": parse_bool,
+        "web.sync_horizon": int,
+        "web.poll_wait": float,
+        "web.redirect_concurrency": int,
+        "web.redirect_cache_ttl": float,
+        "web.cr_cache": parse_bool,
+        "web.aggregate": parse_hosts,
+        "web.aggregate_reconcile": float,
+        "web.ingest_delay": float,
+        "web.ingest_size": int,
+        "web.ingest_max_pending": int,
+        "web.dedup": parse_bool,
+        "web.dedup_max_age": int,
+        "web.dedup_volatile": json.loads,
+        "web.retention_ttl": json.loads,
+        "web.retention_host_cap": json.loads,
+        "web.ws_deflate": parse_bool,
+        "web.ws_deflate_context_takeover": parse_bool,
+        "web.ws_deflate_window_bits": int,
+        "web.ws_deflate_memory": int,
         "web.secret": str,
         "web.secret_name": str,
 
         "deleter.ramdisk": str,
         "deleter.tag": str,
-        "deleter.fake": bool,
+        "deleter.fake": parse_bool,
 
         "simulator.conf": str,
     }
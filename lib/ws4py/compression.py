@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+__doc__ = """
+Server side implementation of the permessage-deflate
+extension (:rfc:`7692`).
+
+An instance of :class:`PerMessageDeflate` holds the server
+configuration and is passed to
+:class:`ws4py.server.wsgiutils.WebSocketWSGIApplication`
+as one of its ``extensions``. Each accepted offer yields a
+:class:`DeflateContext` which is handed to the websocket
+and compresses/decompresses its messages.
+
+.. code-block:: python
+   :linenos:
+
+   >>> from ws4py.compression import PerMessageDeflate
+   >>> app = WebSocketWSGIApplication(handler_cls=EchoWebSocket,
+   ...     extensions=[PerMessageDeflate(max_memory=128*1024)])
+"""
+import zlib
+
+__all__ = ['PerMessageDeflate', 'DeflateContext', 'parse_extensions']
+
+# appended by a sync flush, removed from the messages on the wire
+DEFLATE_TAIL = b'\x00\x00\xff\xff'
+
+MIN_WINDOW_BITS = 9
+MAX_WINDOW_BITS = 15
+
+def parse_extensions(value):
+    """
+    Parses a ``Sec-WebSocket-Extensions`` header value
+    into a list of ``(name, params)`` tuples. Parameters
+    without a value are set to ``None``.
+
+    Returns ``None`` for a parameter declared twice
+    within the same offer, as such an offer must be declined.
+    """
+    offers = []
+    for ext in value.split(','):
+        parts = [p.strip() for p in ext.split(';')]
+        if not parts[0]:
+            continue
+
+        params = {}
+        for p in parts[1:]:
+            if not p:
+                continue
+
+            if '=' in p:
+                k, v = p.split('=', 1)
+                k, v = k.strip(), v.strip().strip('"')
+            else:
+                k, v = p, None
+
+            if k in params:
+                params = None
+                break
+
+            params[k] = v
+
+        offers.append((parts[0], params))
+
+    return offers
+
+def compressor_memory(window_bits, mem_level):
+    # as documented in zconf.h
+    return (1 << (window_bits + 2)) + (1 << (mem_level + 9))
+
+class PerMessageDeflate(object):
+    name = 'permessage-deflate'
+
+    def __init__(self, server_no_context_takeover=False, client_no_context_takeover=False,
+                 server_max_window_bits=MAX_WINDOW_BITS, client_max_window_bits=MAX_WINDOW_BITS,
+                 compress_level=6, mem_level=8, max_memory=None,
+                 min_size=64, compress_binary=True):
+        """
+        Server configuration of the permessage-deflate extension.
+
+        ``server_no_context_takeover`` resets the compressor
+        after each message, the compressor is then only kept
+        in memory while a message is compressed.
+        ``client_no_context_takeover`` asks the client to do the same.
+
+        ``server_max_window_bits`` and ``client_max_window_bits``
+        limit the LZ77 window of each side (9 to 15).
+
+        ``max_memory`` caps the memory used by the compressor
+        of a single connection, in bytes. The window size and
+        then the memory level are lowered until it fits.
+
+        Messages shorter than ``min_size`` bytes are sent uncompressed,
+        as are binary messages unless ``compress_binary`` is set.
+        """
+        for bits in (server_max_window_bits, client_max_window_bits):
+            if not MIN_WINDOW_BITS <= bits <= MAX_WINDOW_BITS:
+                raise ValueError('Window bits must be between %d and %d' % (MIN_WINDOW_BITS, MAX_WINDOW_BITS))
+
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.server_max_window_bits = server_max_window_bits
+        self.client_max_window_bits = client_max_window_bits
+        self.compress_level = compress_level
+        self.mem_level = mem_level
+        self.min_size = min_size
+        self.compress_binary = compress_binary
+
+        if max_memory is not None:
+            while compressor_memory(self.server_max_window_bits, self.mem_level) > max_memory:
+                if self.server_max_window_bits > 12 or (self.server_max_window_bits > MIN_WINDOW_BITS and self.mem_level <= 4):
+                    self.server_max_window_bits -= 1
+                elif self.mem_level > 1:
+                    self.mem_level -= 1
+                else:
+                    break
+
+    def negotiate(self, params):
+        """
+        Validates a client offer, ``params`` as returned
+        by :func:`parse_extensions`.
+
+        Returns a tuple of the response to send in the
+        ``Sec-WebSocket-Extensions`` header and the
+        :class:`DeflateContext` of the connection, or ``None``
+        if the offer can't be accepted.
+        """
+        if params is None:
+            return None
+
+        known = ('server_no_context_takeover', 'client_no_context_takeover',
+                 'server_max_window_bits', 'client_max_window_bits')
+        for k, v in params.items():
+            if k not in known:
+                return None
+            if k.endswith('_takeover') and v is not None:
+                return None
+
+        window_bits = self.server_max_window_bits
+        if 'server_max_window_bits' in params:
+            try:
+                offered = int(params['server_max_window_bits'])
+            except (TypeError, ValueError):
+                return None
+
+            # zlib can't produce a 256 bytes window
+            if not MIN_WINDOW_BITS <= offered <= MAX_WINDOW_BITS:
+                return None
+
+            window_bits = min(window_bits, offered)
+
+        client_window_bits = None
+        if 'client_max_window_bits' in params:
+            offered = params['client_max_window_bits']
+            try:
+                offered = MAX_WINDOW_BITS if offered is None else int(offered)
+            except ValueError:
+                return None
+
+            if not 8 <= offered <= MAX_WINDOW_BITS:
+                return None
+
+            client_window_bits = min(self.client_max_window_bits, offered)
+
+        no_context_takeover = self.server_no_context_takeover or 'server_no_context_takeover' in params
+        client_no_context_takeover = self.client_no_context_takeover or 'client_no_context_takeover' in params
+
+        response = [self.name]
+        if no_context_takeover:
+            response.append('server_no_context_takeover')
+        if self.client_no_context_takeover:
+            response.append('client_no_context_takeover')
+        if window_bits < MAX_WINDOW_BITS or 'server_max_window_bits' in params:
+            response.append('server_max_window_bits=%d' % window_bits)
+        if client_window_bits is not None and client_window_bits < MAX_WINDOW_BITS:
+            response.append('client_max_window_bits=%d' % client_window_bits)
+
+        ctx = DeflateContext(window_bits=window_bits,
+                             no_context_takeover=no_context_takeover,
+                             client_no_context_takeover=client_no_context_takeover,
+                             compress_level=self.compress_level,
+                             mem_level=self.mem_level,
+                             min_size=self.min_size,
+                             compress_binary=self.compress_binary)
+
+        return '; '.join(response), ctx
+
+class DeflateContext(object):
+    def __init__(self, window_bits=MAX_WINDOW_BITS, no_context_takeover=False,
+                 client_no_context_takeover=False, compress_level=6, mem_level=8,
+                 min_size=64, compress_binary=True):
+        """
+        Compression state of a single connection.
+
+        Messages from the client are always inflated with the
+        largest window, which accepts any smaller one as well.
+        """
+        self.name = PerMessageDeflate.name
+        self.window_bits = window_bits
+        self.no_context_takeover = no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.compress_level = compress_level
+        self.mem_level = mem_level
+        self.min_size = min_size
+        self.compress_binary = compress_binary
+
+        self._compressor = None
+        self._decompressor = None
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def should_compress(self, data, binary=False):
+        """
+        Tells if a message is worth compressing.
+        """
+        if binary and not self.compress_binary:
+            return False
+
+        return len(data) >= self.min_size
+
+    def compress(self, data):
+        """
+        Compresses the payload of a whole message.
+        """
+        if self._compressor is None:
+            self._compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED,
+                                                -self.window_bits, self.mem_level)
+
+        body = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if body.endswith(DEFLATE_TAIL):
+            body = body[:-len(DEFLATE_TAIL)]
+
+        if self.no_context_takeover:
+            self._compressor = None
+
+        self.bytes_in += len(data)
+        self.bytes_out += len(body)
+
+        return body
+
+    def decompress(self, data):
+        """
+        Inflates the payload of a whole compressed message.
+        """
+        if self._decompressor is None:
+            self._decompressor = zlib.decompressobj(-MAX_WINDOW_BITS)
+
+        try:
+            body = self._decompressor.decompress(bytes(data) + DEFLATE_TAIL)
+        except zlib.error:
+            self._decompressor = None
+            raise
+
+        if self.client_no_context_takeover:
+            self._decompressor = None
+
+        return body
+
+    def __str__(self):
+        return self.name
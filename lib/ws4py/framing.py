@@ -47,6 +47,12 @@ class Frame(object):
         self.rsv3 = rsv3
         self.payload_length = len(body)
 
+        self.rsv1_allowed = False
+        """
+        Set when an extension using the RSV1 bit (permessage-deflate)
+        was negotiated on the connection.
+        """
+
         self._parser = None
 
     @property
@@ -147,7 +153,11 @@ class Frame(object):
         # frame-rsv1 = %x0 ; 1 bit, MUST be 0 unless negotiated otherwise
         # frame-rsv2 = %x0 ; 1 bit, MUST be 0 unless negotiated otherwise
         # frame-rsv3 = %x0 ; 1 bit, MUST be 0 unless negotiated otherwise
-        if self.rsv1 or self.rsv2 or self.rsv3:
+        if (self.rsv1 and not self.rsv1_allowed) or self.rsv2 or self.rsv3:
+            raise ProtocolException()
+
+        # rsv1 marks a compressed message, it is only valid on its first frame
+        if self.rsv1 and self.opcode not in (0x1, 0x2):
             raise ProtocolException()
 
         # control frames between 3 and 7 as well as above 0xA are currently reserved
@@ -30,6 +30,7 @@ class Message(object):
         """
         self.opcode = opcode
         self._completed = False
+        self.compressed = False
         self.encoding = encoding
 
         if isinstance(data, unicode):
@@ -43,16 +44,18 @@ class Message(object):
 
         self.data = data
 
-    def single(self, mask=False):
+    def single(self, mask=False, rsv1=0):
         """
         Returns a frame bytes with the fin bit set and a random mask.
 
         If ``mask`` is set, automatically mask the frame
         using a generated 4-byte token.
+
+        ``rsv1`` marks a compressed message (permessage-deflate).
         """
         mask = os.urandom(4) if mask else None
         return Frame(body=self.data, opcode=self.opcode,
-                     masking_key=mask, fin=1).build()
+                     masking_key=mask, fin=1, rsv1=rsv1).build()
 
     def fragment(self, first=False, last=False, mask=False):
         """
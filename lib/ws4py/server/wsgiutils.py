@@ -54,6 +54,7 @@ import sys
 from ws4py.websocket import WebSocket
 from ws4py.exc import HandshakeError
 from ws4py.compat import unicode, py3k
+from ws4py.compression import parse_extensions
 from ws4py import WS_VERSION, WS_KEY, format_addresses
 
 logger = logging.getLogger('ws4py')
@@ -71,6 +72,13 @@ class WebSocketWSGIApplication(object):
         is instanciated and stored inside the WSGI `environ`
         under the `'ws4py.websocket'` key to make it
         available to the WSGI handler.
+
+        `extensions` are either names, accepted as they
+        are offered, or objects with a `name` and a
+        `negotiate(params)` method such as
+        :class:`ws4py.compression.PerMessageDeflate`.
+        Those return the response to the offer and the
+        per-connection object handed to the websocket.
         """
         self.protocols = protocols
         self.extensions = extensions
@@ -131,6 +139,7 @@ class WebSocketWSGIApplication(object):
                     ws_protocols.append(s)
 
         ws_extensions = []
+        ws_extensions_response = []
         exts = self.extensions or []
         extensions = environ.get('HTTP_SEC_WEBSOCKET_EXTENSIONS')
         if extensions:
@@ -138,6 +147,21 @@ class WebSocketWSGIApplication(object):
                 ext = ext.strip()
                 if ext in exts:
                     ws_extensions.append(ext)
+                    ws_extensions_response.append(ext)
+
+            # parameterized extensions, the first acceptable offer wins
+            negotiated = set()
+            for name, params in parse_extensions(extensions):
+                for ext in exts:
+                    if not hasattr(ext, 'negotiate') or ext.name != name or name in negotiated:
+                        continue
+
+                    accepted = ext.negotiate(params)
+                    if accepted is not None:
+                        response, ws_ext = accepted
+                        negotiated.add(name)
+                        ws_extensions.append(ws_ext)
+                        ws_extensions_response.append(response)
 
         accept_value = base64.b64encode(sha1(key.encode('utf-8') + WS_KEY).digest())
         if py3k: accept_value = accept_value.decode('utf-8')
@@ -149,8 +173,8 @@ class WebSocketWSGIApplication(object):
             ]
         if ws_protocols:
             upgrade_headers.append(('Sec-WebSocket-Protocol', ', '.join(ws_protocols)))
-        if ws_extensions:
-            upgrade_headers.append(('Sec-WebSocket-Extensions', ','.join(ws_extensions)))
+        if ws_extensions_response:
+            upgrade_headers.append(('Sec-WebSocket-Extensions', ', '.join(ws_extensions_response)))
 
         start_response("101 Switching Protocols", upgrade_headers)
 
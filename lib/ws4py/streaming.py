@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import struct
 from struct import unpack
+import zlib
 
 from ws4py.utf8validator import Utf8Validator
 from ws4py.messaging import TextMessage, BinaryMessage, CloseControlMessage,\
@@ -81,6 +82,12 @@ class Stream(object):
         self.always_mask = always_mask
         self.expect_masking = expect_masking
 
+        self.deflate = None
+        """
+        Negotiated permessage-deflate context
+        (:class:`ws4py.compression.DeflateContext`), if any.
+        """
+
     @property
     def parser(self):
         if self._parser is None:
@@ -179,6 +186,7 @@ class Stream(object):
         frame = None
         while running:
             frame = Frame()
+            frame.rsv1_allowed = self.deflate is not None
             while 1:
                 try:
                     some_bytes = (yield next(frame.parser))
@@ -222,9 +230,13 @@ class Stream(object):
 
                         m = TextMessage(some_bytes)
                         m.completed = (frame.fin == 1)
+                        m.compressed = (frame.rsv1 == 1)
                         self.message = m
 
-                        if some_bytes:
+                        if m.compressed:
+                            # validated once inflated
+                            pass
+                        elif some_bytes:
                             is_valid, end_on_code_point, _, _ = utf8validator.validate(some_bytes)
 
                             if not is_valid or (m.completed and not end_on_code_point):
@@ -240,6 +252,7 @@ class Stream(object):
 
                         m = BinaryMessage(some_bytes)
                         m.completed = (frame.fin == 1)
+                        m.compressed = (frame.rsv1 == 1)
                         self.message = m
 
                     elif frame.opcode == OPCODE_CONTINUATION:
@@ -250,7 +263,7 @@ class Stream(object):
 
                         m.extend(some_bytes)
                         m.completed = (frame.fin == 1)
-                        if m.opcode == OPCODE_TEXT:
+                        if m.opcode == OPCODE_TEXT and not m.compressed:
                             if some_bytes:
                                 is_valid, end_on_code_point, _, _ = utf8validator.validate(some_bytes)
 
@@ -310,6 +323,19 @@ class Stream(object):
             frame.body = None
             frame = None
 
+            m = self.message
+            if m is not None and m.completed and m.compressed and not self.errors:
+                try:
+                    m.data = self.deflate.decompress(m.data)
+                    m.compressed = False
+                except zlib.error:
+                    self.errors.append(CloseControlMessage(code=1007, reason='Invalid compressed data'))
+                else:
+                    if m.opcode == OPCODE_TEXT and m.data:
+                        is_valid, end_on_code_point, _, _ = utf8validator.validate(bytearray(m.data))
+                        if not is_valid or not end_on_code_point:
+                            self.errors.append(CloseControlMessage(code=1007, reason='Invalid UTF-8 bytes'))
+
             if self.message is not None and self.message.completed:
                 utf8validator.reset()
 
@@ -100,9 +100,14 @@ class WebSocket(object):
         self.extensions = extensions
         """
         List of extensions supported by this endpoint.
-        Unused for now.
+        Only permessage-deflate is acted upon, see
+        :mod:`ws4py.compression`.
         """
 
+        for ext in extensions or []:
+            if getattr(ext, 'name', None) == 'permessage-deflate':
+                self.stream.deflate = ext
+
         self.sock = sock
         """
         Underlying connection.
@@ -295,12 +300,20 @@ class WebSocket(object):
         fragmented message.
 
         If ``binary`` is set, handles the payload as a binary message.
+
+        Single messages are compressed if permessage-deflate
+        was negotiated, fragmented ones are sent as they are.
         """
         message_sender = self.stream.binary_message if binary else self.stream.text_message
+        deflate = self.stream.deflate
 
         if isinstance(payload, basestring) or isinstance(payload, bytearray):
-            m = message_sender(payload).single(mask=self.stream.always_mask)
-            self._write(m)
+            m = message_sender(payload)
+            if deflate is not None and deflate.should_compress(m.data, binary):
+                m.data = deflate.compress(m.data)
+                self._write(m.single(mask=self.stream.always_mask, rsv1=1))
+            else:
+                self._write(m.single(mask=self.stream.always_mask))
 
         elif isinstance(payload, Message):
             data = payload.single(mask=self.stream.always_mask)
@@ -0,0 +1,29 @@
+import sqlite3
+import os, sys, time
+
+# one time conversion of a web database to auto_vacuum=INCREMENTAL,
+# which lets the retention engine give the free pages back (see RetentionEngine)
+#
+# the VACUUM rewrites the whole database: stop fff_dqmtools first
+# and make sure there is free disk space for a second copy of it
+
+if __name__  == "__main__":
+    if len(sys.argv) != 2:
+        print( "Usage: %s <database_file>" % sys.argv[0])
+        sys.exit(1)
+
+    db = sys.argv[1]
+    conn = sqlite3.connect(db, isolation_level=None)
+
+    mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    if mode == 2:
+        print( "Database %s already uses auto_vacuum=INCREMENTAL." % db)
+        sys.exit(0)
+
+    print( "Converting %s (%d bytes), this will take a while." % (db, os.path.getsize(db)))
+    started = time.time()
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+    conn.close()
+
+    print( "Database converted in %.2f seconds (%d bytes)." % (time.time() - started, os.path.getsize(db)))
@@ -0,0 +1,175 @@
+import collections
+import fnmatch
+import logging
+import os
+import re
+import threading
+
+log = logging.getLogger(__name__)
+
+SELECTED_RELEASE = "Selected release: "
+MERGE_SUCCESSFUL = "Merge successful"
+GLOBAL_TAG = "GlobalTag.globaltag = "
+
+merge_log_re = re.compile(r"^merge\.(.+)\.log$")
+
+class ReleaseInspector(object):
+    """ Reads the logs and configuration of a release area
+        (made by cmssw_deploy), replaces the grep/find pipelines.
+
+        Every file is parsed in a single pass and the result is kept
+        until the file changes (same path, mtime and size),
+        for at most max_files files (the least recently used are dropped).
+        The text is only kept if the caller asks for it (keep_text).
+
+        It is used from threads (the file I/O must not block the web server).
+    """
+
+    def __init__(self, max_files=10000):
+        self.max_files = max_files
+
+        self.memo = collections.OrderedDict() # path -> ((mtime, size), parsed)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.parsed = 0
+        self.evicted = 0
+
+    def forget(self, fp):
+        with self.lock:
+            self.memo.pop(fp, None)
+
+    def prune(self, path=None):
+        """ Drops the files (under path) which no longer exist. """
+        prefix = None
+        if path is not None:
+            prefix = os.path.join(path, "")
+
+        with self.lock:
+            lst = [fp for fp in self.memo if prefix is None or fp.startswith(prefix)]
+
+        for fp in lst:
+            if not os.path.exists(fp):
+                self.forget(fp)
+
+    def parse_file(self, fp, keep_text=False):
+        try:
+            st = os.stat(fp)
+        except OSError:
+            self.forget(fp)
+            return None
+
+        key = (st.st_mtime, st.st_size, )
+        with self.lock:
+            cached = self.memo.get(fp, None)
+            if cached is not None and cached[0] == key and (cached[1]["text"] is not None or not keep_text):
+                self.hits += 1
+                self.memo.move_to_end(fp)
+                return cached[1]
+
+        parsed = {
+            "selected_release": None,
+            "merged": False,
+            "global_tags": [],
+            "text": None,
+        }
+
+        try:
+            with open(fp, "r", errors="replace") as f:
+                text = f.read()
+        except OSError:
+            self.forget(fp)
+            return None
+
+        for line in text.splitlines():
+            if SELECTED_RELEASE in line:
+                parsed["selected_release"] = line.split(SELECTED_RELEASE)[-1]
+            if MERGE_SUCCESSFUL in line:
+                parsed["merged"] = True
+            if GLOBAL_TAG in line:
+                parsed["global_tags"].append(line)
+
+        if keep_text:
+            parsed["text"] = text
+
+        with self.lock:
+            self.parsed += 1
+            self.memo[fp] = (key, parsed, )
+            self.memo.move_to_end(fp)
+
+            while len(self.memo) > self.max_files:
+                self.memo.popitem(last=False)
+                self.evicted += 1
+
+        return parsed
+
+    def list_files(self, path, pattern):
+        try:
+            names = sorted(os.listdir(path))
+        except OSError:
+            return []
+
+        return [os.path.join(path, x) for x in names if fnmatch.fnmatch(x, pattern)]
+
+    def selected_release(self, path):
+        """ "<arch> <tag>" of the last "Selected release:" in the logs. """
+        release = None
+        for fp in self.list_files(path, "*.log"):
+            parsed = self.parse_file(fp)
+            if parsed and parsed["selected_release"] is not None:
+                release = parsed["selected_release"]
+
+        return release
+
+    def pull_requests(self, path, keep_text=False):
+        """ Merge logs of the release area (merge.<label>.log),
+            "log" is only filled with keep_text.
+        """
+        lst = []
+        for fp in self.list_files(path, "merge.*.log"):
+            parsed = self.parse_file(fp, keep_text=keep_text)
+            if parsed is None:
+                continue
+
+            lst.append({
+                "label": merge_log_re.match(os.path.basename(fp)).group(1),
+                "path": fp,
+                "merged": parsed["merged"],
+                "log": parsed["text"],
+            })
+
+        return lst
+
+    def global_tags(self, path):
+        """ GlobalTag assignments in DQM/Integration/python/config, as "<file>:<line>". """
+        config = os.path.join(path, "src/DQM/Integration/python/config")
+
+        lst = []
+        for root, dirs, files in os.walk(config):
+            dirs.sort()
+            for name in sorted(files):
+                fp = os.path.join(root, name)
+                parsed = self.parse_file(fp)
+                if parsed is None:
+                    continue
+
+                lst += [fp + ":" + line for line in parsed["global_tags"]]
+
+        return lst
+
+    def inspect(self, path):
+        self.prune(path)
+
+        return {
+            "release": self.selected_release(path),
+            "pull_requests": self.pull_requests(path),
+            "global_tags": self.global_tags(path),
+        }
+
+    def stats(self):
+        return {
+            "files": len(self.memo),
+            "hits": self.hits,
+            "parsed": self.parsed,
+            "evicted": self.evicted,
+        }
@@ -184,6 +184,15 @@ dqmApp.controller('NavigationCtrl', [
     $scope._ = _;
 
     $scope.$watch(LocParams.watchFunc('hosts'),  update_connections);
+
+    // ?syncType=dqm-files,dqm-source-state limits what the servers send us
+    $scope.$watch(LocParams.watchFunc('syncType'), function (v) {
+        if (v && (v !== true)) {
+            SyncPool.set_filter({ 'type': v.split(",") });
+        } else {
+            SyncPool.set_filter(null);
+        }
+    });
 }]);
 
 dqmApp.controller('LumiRunCtrl', ['$scope', '$rootScope', 'SyncPool', 'LocParams', 'SyncRun', 'RunStats', function($scope, $rootScope, SyncPool, LocParams, SyncRun, RunStats) {
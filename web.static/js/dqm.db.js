@@ -31,6 +31,9 @@ var Connection = function (uri) {
     // catch-all
     this.x_onevent   = noop;
 
+    // http only, time to ask for updates again
+    this.x_onpoll    = noop;
+
     // this is for displaying stuff
     // should not be used as a state machine
     this.make_state = function (state, description) {
@@ -63,11 +66,41 @@ Connection.make_websocket = function (uri) {
         me.retry_count = me.retry_count + 1;
 
         me.ws = new WebSocket(me.uri);
-        me.ws.onmessage = function (evt) {
+        me.ws.binaryType = "arraybuffer";
+        // binary frames are decoded asynchronously,
+        // messages are still handled in the order they arrived:
+        // each one waits (in me.inbox) for the ones before it
+        me.inbox = Promise.resolve();
+        me.inbox_pending = 0;
+
+        var deliver = function (evt) {
             me.x_onmessage(evt);
             me.x_onevent(evt);
         };
 
+        me.ws.onmessage = function (evt) {
+            if ((!(evt.data instanceof ArrayBuffer)) && (me.inbox_pending === 0)) {
+                deliver(evt);
+                return;
+            }
+
+            var decoded = evt;
+            if (evt.data instanceof ArrayBuffer) {
+                decoded = Connection.decode_binary(evt.data).then(function (msg) {
+                    return { 'type': 'message', 'data': msg };
+                });
+            }
+
+            me.inbox_pending = me.inbox_pending + 1;
+            me.inbox = me.inbox.then(function () {
+                return decoded;
+            }).then(deliver).catch(function (e) {
+                console.log("Failed to process a message: ", e);
+            }).then(function () {
+                me.inbox_pending = me.inbox_pending - 1;
+            });
+        };
+
         me.ws.onopen = function (evt) {
             me.make_state("open");
 
@@ -125,6 +158,71 @@ Connection.make_websocket = function (uri) {
 };
 
 
+// stored documents can be received as they are (zlib streams),
+// if the browser can inflate them
+Connection.supports_deflate = (typeof DecompressionStream !== "undefined");
+
+// binary frame: 4 byte length of the json part, the json part, zlib streams
+// the sizes of the zlib streams are listed in "parts"
+// returns a promise to the decoded message (an object, not a string)
+Connection.decode_binary = function (buf) {
+    var view = new DataView(buf);
+    var head_size = view.getUint32(0);
+    var decoder = new TextDecoder("utf-8");
+
+    var msg = JSON.parse(decoder.decode(new Uint8Array(buf, 4, head_size)));
+    var offset = 4 + head_size;
+
+    var promises = _.map(msg["parts"] || [], function (size) {
+        var part = new Uint8Array(buf, offset, size);
+        offset = offset + size;
+
+        var stream = new Blob([part]).stream().pipeThrough(new DecompressionStream("deflate"));
+        return new Response(stream).text().then(JSON.parse);
+    });
+
+    return Promise.all(promises).then(function (docs) {
+        msg["documents"] = (msg["documents"] || []).concat(docs);
+        delete msg["parts"];
+
+        return msg;
+    });
+};
+
+// headers in the "columns" format: a list per key, a value per header
+// string columns are indexes into "strings", "_rev" is delta encoded
+Connection.decode_columns = function (msg) {
+    var columns = msg["columns"];
+    var strings = msg["strings"];
+    var headers = new Array(msg["count"]);
+
+    for (var i = 0; i < msg["count"]; i++)
+        headers[i] = {};
+
+    _.each(msg["keys"], function (key) {
+        var col = columns[key];
+        var i, v;
+
+        if (key == "_rev") {
+            v = 0;
+            for (i = 0; i < col.length; i++) {
+                v = v + col[i];
+                headers[i][key] = v;
+            }
+        } else if (key == "hostname" || key == "type" || key == "tag") {
+            for (i = 0; i < col.length; i++) {
+                v = col[i];
+                headers[i][key] = (v === null) ? null : strings[v];
+            }
+        } else {
+            for (i = 0; i < col.length; i++)
+                headers[i][key] = col[i];
+        }
+    });
+
+    return headers;
+};
+
 // unmaintained and untested
 Connection.make_http_proxy = function (uri) {
     // retry logic: always reconnect (we have 5s ticks)
@@ -132,6 +230,21 @@ Connection.make_http_proxy = function (uri) {
 
     me.requests = 0;
 
+    // sync requests are long-polls, the server holds them (up to long_poll seconds)
+    // until there are new headers, we ask again as soon as one returns
+    me.long_poll = 25;
+    me.poll_t = undefined;
+
+    me.schedule_poll = function (delay) {
+        if (me.poll_t !== undefined)
+            return;
+
+        me.poll_t = setTimeout(function () {
+            me.poll_t = undefined;
+            me.x_onpoll({ 'type': 'poll' });
+        }, delay);
+    };
+
     me.open = function () {
         console.log("Created connection object: ", me.uri, me);
         me.make_state("open", "http mode");
@@ -152,15 +265,23 @@ Connection.make_http_proxy = function (uri) {
     };
 
     me.send = function (msg) {
-        me.update_state(1);
+        var is_poll = (angular.fromJson(msg)["event"] == "sync_request");
+        var request = { 'messages': [msg] };
+
+        if (is_poll) {
+            request['wait'] = me.long_poll;
+        } else {
+            me.update_state(1);
+        }
 
         jQuery.ajax({
             url: me.uri,
             method: 'POST',
             dataType: 'json',
-            data: angular.toJson({ 'messages': [msg] }),
+            data: angular.toJson(request),
             success: function (body) {
-                me.update_state(-1);
+                if (! is_poll) me.update_state(-1);
+
                 _.each(body.messages, function (msg) {
                     var fake_evt = { 'type': 'message', 'data': msg };
                     me.x_onmessage(fake_evt);
@@ -168,18 +289,29 @@ Connection.make_http_proxy = function (uri) {
                 });
 
                 me.x_onevent({ 'type': 'notify' });
+
+                if (is_poll) me.schedule_poll(0);
             },
             error: function () {
-                me.update_state(-1);
+                if (! is_poll) me.update_state(-1);
                 console.log("http2websocket proxy failed", arguments);
 
                 me.x_onerror({ 'type': 'error' });
                 me.x_onevent({ 'type': 'error' });
+
+                if (is_poll) me.schedule_poll(5*1000);
             }
         });
     };
 
-    me.close = function () {};
+    me.close = function () {
+        if (me.poll_t !== undefined)
+            clearTimeout(me.poll_t);
+
+        me.poll_t = undefined;
+        me.x_onpoll = function () {};
+    };
+
     return me;
 };
 
@@ -193,6 +325,9 @@ mod.factory('SyncPool', ['$http', '$window', '$rootScope', '$timeout', function
     factory._sync_headers = {};
     factory._sync_header_handlers = [];
 
+    // server side filter, see HeaderFilter in fff_web.py
+    factory._sync_filter = null;
+
     var max_rev = function () {
         var args = Array.prototype.slice.call(arguments);
         return _.reduce(args, function (a, b) {
@@ -208,16 +343,46 @@ mod.factory('SyncPool', ['$http', '$window', '$rootScope', '$timeout', function
 
     // interfaces for the Connection
     factory._handle_connection = function (conn, evt) {
-        conn.send(angular.toJson({
+        var msg = {
             'event': 'sync_request',
             'known_rev': conn._sync_last_rev,
-        }));
+            'format': 'columns',
+        };
+
+        if (factory._sync_filter)
+            msg['filter'] = factory._sync_filter;
+
+        conn.send(angular.toJson(msg));
     };
 
     factory._handle_message = function (conn, evt) {
         var msg = angular.fromJson(evt.data);
 
-        if (msg["event"] == "update_headers") {
+        if ((msg["event"] == "update_headers") && (msg["format"] == "columns"))
+            msg["headers"] = Connection.decode_columns(msg);
+
+        if (msg["event"] == "sync_error") {
+            // the sync request was rejected (ie, an invalid filter)
+            console.log("Sync request rejected: ", conn.uri, msg["error"]);
+        }
+
+        if (msg["event"] == "sync_window") {
+            // server only sent headers from first_rev, older ones are available on request
+            conn._sync_first_rev = msg["first_rev"];
+            conn._sync_older = msg["older_available"];
+        }
+
+        if ((msg["event"] == "update_headers") && msg["older"]) {
+            var headers = _.map(msg["headers"], function (head) {
+                head["_source"] = conn.uri;
+                factory._sync_headers[head["_id"]] = head;
+                return head;
+            });
+
+            _.each(factory._sync_header_handlers, function (handler) {
+                handler(headers, false);
+            });
+        } else if (msg["event"] == "update_headers") {
             conn._sync_last_rev = max_rev(conn._sync_last_rev, msg["rev"][1]);
 
             var headers = _.map(msg["headers"], function (head) {
@@ -263,7 +428,10 @@ mod.factory('SyncPool', ['$http', '$window', '$rootScope', '$timeout', function
         }
 
         conn._sync_last_rev = null;
+        conn._sync_first_rev = null;
+        conn._sync_older = false;
         conn.x_onopen = function (evt) { return factory._handle_connection(conn, evt); };
+        conn.x_onpoll = function (evt) { return factory._handle_connection(conn, evt); };
         conn.x_onmessage = function (evt) { return factory._handle_message(conn, evt); };
         conn.x_onevent = function (evt) { return factory._handle_evt(conn, evt); };
 
@@ -303,6 +471,36 @@ mod.factory('SyncPool', ['$http', '$window', '$rootScope', '$timeout', function
         };
     };
 
+    // changing the filter requires a full resync
+    factory.set_filter = function (filter) {
+        if (angular.equals(filter, factory._sync_filter))
+            return;
+
+        factory._sync_filter = filter;
+
+        var uris = _.keys(factory._conn);
+        _.each(uris, factory.disconnect);
+        _.each(uris, factory.connect);
+    };
+
+    // the initial sync is limited to the server's time horizon
+    factory.has_older = function () {
+        return _.some(factory._conn, function (conn) { return conn._sync_older; });
+    };
+
+    factory.load_older = function () {
+        _.each(factory._conn, function (conn) {
+            if (! conn._sync_older)
+                return;
+
+            conn._sync_older = false;
+            conn.send(angular.toJson({
+                'event': 'request_older',
+                'before_rev': conn._sync_first_rev,
+            }));
+        });
+    };
+
     factory.send_message = function (uri, msg) {
         var c = factory._conn[uri];
         c.send(msg);
@@ -350,9 +548,20 @@ mod.factory('SyncDocument', ['SyncPool', '$window', '$http', '$q', function (Syn
     var factory = {};
     factory._requests = [];
 
+    // tracked ids (with a reference count), the server pushes their new revisions
+    // together with the headers, the latest pushed document is kept in _pushed
+    factory._tracked = {};
+    factory._pushed = {};
+    factory._subscribe_t = undefined;
+
     factory._make_request = function (request) {
         var source = request["source"];
         var msg = { 'event': "request_documents", 'ids': [request["id"]] };
+
+        // binary frames only work over websocket
+        if (Connection.supports_deflate && SyncPool._conn[source].ws)
+            msg["encoding"] = "deflate";
+
         SyncPool.send_message(source, angular.toJson(msg));
     };
 
@@ -379,13 +588,112 @@ mod.factory('SyncDocument', ['SyncPool', '$window', '$http', '$q', function (Syn
         });
     };
 
+    // applies the operations of a delta (see json_diff in fff_web.py) to a copy of doc
+    factory.apply_delta = function (doc, ops) {
+        var root = { 'doc': angular.copy(doc) };
+
+        _.each(ops, function (op) {
+            var path = ["doc"].concat(op[1]);
+            var parent = root;
+            for (var i = 0; i < path.length - 1; i++)
+                parent = parent[path[i]];
+
+            var key = path[path.length - 1];
+            if (op[0] == "set") {
+                parent[key] = op[2];
+            } else if (op[0] == "del") {
+                delete parent[key];
+            } else if (op[0] == "append") {
+                parent[key] = parent[key].concat(op[2]);
+            } else if (op[0] == "shift") {
+                parent[key] = parent[key].slice(op[2]);
+            }
+        });
+
+        return root["doc"];
+    };
+
+    factory._process_pushed = function (docs, deltas) {
+        // deltas only apply to the revision we have, otherwise the document is fetched
+        _.each(deltas, function (delta) {
+            var base = factory._pushed[delta["_id"]];
+            if (base && base._rev === delta["base_rev"])
+                docs.push(factory.apply_delta(base, delta["ops"]));
+        });
+
+        _.each(docs, function (doc) {
+            if (factory._tracked[doc["_id"]])
+                factory._pushed[doc["_id"]] = doc;
+        });
+
+        factory._process_response(docs);
+    };
+
+    factory._send_subscriptions = function (source) {
+        var ids = _.filter(_.keys(factory._tracked), function (id) {
+            var header = SyncPool._sync_headers[id];
+            return header && (header._source === source);
+        });
+
+        SyncPool.send_message(source, angular.toJson({ 'event': "subscribe_documents", 'ids': ids }));
+    };
+
+    factory._update_subscriptions = function () {
+        // batch the changes, cachers enter and exit documents one by one
+        if (factory._subscribe_t !== undefined)
+            return;
+
+        factory._subscribe_t = $window.setTimeout(function () {
+            factory._subscribe_t = undefined;
+
+            _.each(_.keys(SyncPool._conn), function (source) {
+                // only websockets keep the subscription
+                if (SyncPool._conn[source].ws)
+                    factory._send_subscriptions(source);
+            });
+        }, 100);
+    };
+
+    factory.track = function (id) {
+        factory._tracked[id] = (factory._tracked[id] || 0) + 1;
+        factory._update_subscriptions();
+    };
+
+    factory.untrack = function (id) {
+        factory._tracked[id] = (factory._tracked[id] || 1) - 1;
+        if (factory._tracked[id] > 0)
+            return;
+
+        delete factory._tracked[id];
+        delete factory._pushed[id];
+        factory._update_subscriptions();
+    };
+
+    // pushed document, if it matches the revision
+    factory.get_pushed = function (id, rev) {
+        var doc = factory._pushed[id];
+        if (doc && doc._rev === rev)
+            return doc;
+
+        return undefined;
+    };
+
     factory._process_event = function (conn, evt) {
         if (evt["type"] == "message") {
             var msg = angular.fromJson(evt.data);
+            if (msg["event"] == "update_headers" && (msg.documents || msg.deltas)) {
+                factory._process_pushed(msg.documents || [], msg.deltas || []);
+                return;
+            }
+
             if (msg["event"] !=  "update_documents")
                 return;
 
             factory._process_response(msg.documents);
+        } else if (evt["type"] == "open") {
+            // subscriptions are per connection
+            if (conn.ws)
+                factory._update_subscriptions();
         } else if (evt["type"] == "close") {
             var source = conn.uri;
             var to_rej = _.filter(factory._requests, function (r) { return (r["source"] === source); });
@@ -467,9 +775,15 @@ mod.factory('CachedDocument', ['SyncPool', 'SyncDocument', '$window', '$http', '
         cacher._doc_map = {};
         cacher._doc_requests = {};
 
+        // ask the server to push new revisions of the documents
+        cacher._track = true;
+
         cacher._enter_document = function (id) {
             // needs to be a clone
             cacher._doc_map[id] = _.clone(SyncPool._sync_headers[id]);
+
+            if (cacher._track)
+                SyncDocument.track(id);
         };
 
         cacher._refresh_document = function (id) {
@@ -502,6 +816,15 @@ mod.factory('CachedDocument', ['SyncPool', 'SyncDocument', '$window', '$http', '
             }
 
             // at this step either doc is not existing or too old
+            // it might have been pushed with the header
+            var pushed = SyncDocument.get_pushed(id, header._rev);
+            if (pushed) {
+                pushed["$cd_full"] = true;
+                cacher._doc_map[id] = pushed;
+                cacher.update();
+                return;
+            }
+
             // create a promise for it
             var p = SyncDocument.fetch(id);
             cacher._doc_requests[id] = p;
@@ -537,6 +860,9 @@ mod.factory('CachedDocument', ['SyncPool', 'SyncDocument', '$window', '$http', '
                 delete cacher._doc_requests[id];
             }
 
+            if (cacher._track)
+                SyncDocument.untrack(id);
+
             delete cacher._doc_map[id];
         };
 
@@ -580,6 +906,9 @@ mod.factory('CachedDocument', ['SyncPool', 'SyncDocument', '$window', '$http', '
         var cacher = me.make_cacher_obj();
         var deferred = $q.defer();
 
+        // one-off, no need for the pushes
+        cacher._track = false;
+
         cacher.update = function () {
             // check if all is fetch
 